@@ -3,7 +3,7 @@ import os
 import asyncio
 
 from bntl.db import DBClient
-from bntl.vector import VectorClient
+from bntl.vector import create_vector_client
 from bntl.settings import settings
 from vectorizer.db import DBClient as VectorizerDBClient
 
@@ -12,7 +12,7 @@ async def main():
     db_client = await DBClient.create()
     await db_client._clear_up()
 
-    vector_client = VectorClient()
+    vector_client = create_vector_client()
     await vector_client._clear_up()
     db_client = await VectorizerDBClient.create()
     await db_client._clear_up()
@@ -21,7 +21,6 @@ async def main():
         for f in os.listdir(settings.UPLOAD_LOG_DIR):
             os.remove(os.path.join(settings.UPLOAD_LOG_DIR, f))
 
-    # TODO: remove revectorize-* files
 
 if __name__ == '__main__':
     asyncio.run(main())
\ No newline at end of file
@@ -1,8 +1,10 @@
 
 import io
 import os
+import re
+import hmac
 import logging
-from typing import List
+from typing import List, Literal, Optional
 import urllib.parse
 from datetime import datetime, timezone
 from contextlib import asynccontextmanager
@@ -10,7 +12,6 @@ import uuid
 from bson.objectid import ObjectId
 import humanize
 import aiofiles
-import rispy
 
 from fastapi import FastAPI, Request, Depends, Response, status
 from fastapi import UploadFile, File, BackgroundTasks, HTTPException, Form, Query
@@ -20,15 +21,15 @@ from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from fastapi_babel import BabelConfigs, BabelMiddleware
 
-from bntl.vector import VectorClient, MissingVectorException
+from bntl.vector import create_vector_client, add_payloads, MissingVectorException, CONNECTION_ERRORS
 from bntl.db import DBClient
 from bntl.models import QueryParams, VectorParams, LoginParams, PageParams
 from bntl.models import DBEntryModel, VectorEntryModel, FileUploadModel
 from bntl.models import DocScreen
-from bntl.pagination import paginate, paginate_within, build_query
-from bntl.upload import Status, FileUploadManager, convert_to_text
+from bntl.pagination import paginate, paginate_within, paginate_hits, build_query, parse_sort
+from bntl.upload import Status, FileUploadManager, convert_to_text, TEXT_FIELDS
 from bntl.settings import settings, setup_logger
-from bntl import utils
+from bntl import utils, export, dump, neighbors
 
 from vectorizer import client
 
@@ -48,13 +49,14 @@ VALIDATED_SESSIONS = set()
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     app.state.db_client = await DBClient.create()
-    app.state.vector_client = VectorClient()
+    app.state.vector_client = create_vector_client()
     app.state.file_upload = FileUploadManager(
         app.state.db_client, 
         app.state.vector_client)
     yield
     app.state.db_client.close()
     await app.state.vector_client.close()
+    await client.close_session()
 
 
 app = FastAPI(
@@ -123,6 +125,21 @@ def require_validated_session(request: Request):
         raise RequiresLoginException({"next_url": request.url.path})
 
 
+def require_token(request: Request):
+    """
+    Dependency injection for routes meant for other services: these take a bearer token
+    (or a validated session)
+    """
+    session_id = request.cookies.get("session_id")
+    if session_id and session_id in VALIDATED_SESSIONS:
+        return
+    scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+    expected = settings.DUMP_TOKEN or settings.UPLOAD_SECRET
+    if scheme.lower() != "bearer" or not hmac.compare_digest(token.encode(), expected.encode()):
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token",
+                            headers={"WWW-Authenticate": "Bearer"})
+
+
 @app.get("/login", response_class=HTMLResponse)
 async def login_get(request: Request):
     return templates.TemplateResponse("login.html", {"request": request})
@@ -272,39 +289,65 @@ async def item(doc_id: str, request: Request):
 
 
 @app.get("/vectorQuery")
-async def vector_query(doc_id: str, request: Request, page_params: PageParams=Depends(), vector_params: VectorParams=Depends()):
+async def vector_query(doc_id: str, request: Request,
+                       page_params: PageParams=Depends(),
+                       vector_params: VectorParams=Depends(),
+                       type_of_reference: Optional[str]=None,
+                       year: Optional[str]=None):
     """
-    Vector-based query route using the document id
+    Vector-based query route using the document id. Results can be restricted to a type
+    of reference and a year (range), as well as to a minimum similarity threshold.
     """
+    if year and not re.fullmatch(r"\d+(-\d+)?", year):
+        raise HTTPException(status_code=400, detail=f"Invalid year: {year}")
+    facets = {"type_of_reference": type_of_reference, "year": year}
+    sort = page_params.sort_author or page_params.sort_year
     try:
-        hits = await app.state.vector_client.search(doc_id, limit=vector_params.limit)
+        hits = None
+        if not any(facets.values()) and not vector_params.threshold:
+            # serve from the precomputed neighbor table if available
+            hits = await app.state.db_client.find_neighbors(doc_id, vector_params.limit)
+            n_hits = len(hits or [])
+        if hits is None and sort:
+            hits = await app.state.vector_client.search(
+                doc_id, limit=vector_params.limit, threshold=vector_params.threshold, **facets)
+        elif hits is None:
+            hits, n_hits = await app.state.vector_client.search_page(
+                doc_id, page_params.page, page_params.size, vector_params.limit,
+                threshold=vector_params.threshold, **facets)
+        elif not sort:
+            hits = hits[(page_params.page - 1) * page_params.size: page_params.page * page_params.size]
     except MissingVectorException as e:
         raise HTTPException(status_code=404, detail=str(e))
-    except Exception as e:
+    except CONNECTION_ERRORS:
         raise HTTPException(status_code=500, detail="Vector DB not running")
 
-    hits_mapping = {item["doc_id"]: item["score"] for item in hits}
-
-    def transform(item):
-        item["score"] = hits_mapping[item["doc_id"]]
-        return item
+    if sort:
+        # sort the top-k hits on the requested fields
+        hits_mapping = {item["doc_id"]: item["score"] for item in hits}
 
-    # overwrite pagination, since we are not using it for now
-    page_params.size = 100
-    results = await paginate(
-        app.state.db_client.bntl_coll,
-        QueryParams(), page_params, VectorEntryModel, 
-        within_ids=[ObjectId(item["doc_id"]) for item in hits],
-        transform=transform)
+        def transform(item):
+            item["score"] = hits_mapping[item["doc_id"]]
+            return item
 
-    # ensure we sort by score unless differently specified
-    if not page_params.sort_author and not page_params.sort_year:
-        results.items = sorted(results.items, key=lambda item: hits_mapping[item.doc_id], reverse=True)
+        results = await paginate(
+            app.state.db_client.bntl_coll,
+            QueryParams(), page_params, VectorEntryModel,
+            within_ids=[ObjectId(item["doc_id"]) for item in hits],
+            transform=transform)
+    else:
+        # results come paginated in score order
+        results = await paginate_hits(
+            app.state.db_client.bntl_coll, hits, n_hits, page_params, VectorEntryModel)
 
     # add source
-    source = "/vectorQuery?doc_id=" + doc_id
+    params = {"doc_id": doc_id, **{key: value for key, value in facets.items() if value}}
+    if vector_params.threshold:
+        params["threshold"] = vector_params.threshold
+    source = "/vectorQuery?" + urllib.parse.urlencode(params)
     return templates.TemplateResponse(
-        "results.html", {"request": request, "source": source, **results.model_dump()})
+        "results.html",
+        {"request": request, "source": source, "limit": vector_params.limit, **results.model_dump()})
 
 
 @app.get("/count")
@@ -366,23 +409,72 @@ async def upload_page(request: Request):
          "statuses": Status.__get_classes__()})
 
 
-async def revectorize_task():
+async def revectorize_task(batch_size=None):
+    """
+    Revectorize the entire database into a new version of the vector index. Documents are
+    streamed in batches, each of which is sent to the vectorizer as a sub-task, with the
+    progress being tracked as an upload.
+    """
+    batch_size = batch_size or settings.REVECTORIZE_BATCH_SIZE
+    db_client, vector_client = app.state.db_client, app.state.vector_client
     task_id = "revectorize-" + str(uuid.uuid4())
-    async with utils.AsyncLogger(task_id) as a_logger:
+    await db_client.register_upload(task_id, task_id, Status.VECTORIZING)
+    async with utils.AsyncLogger(utils.get_log_filename(task_id)) as a_logger:
         await a_logger.info("Starting revectorize task: {}".format(task_id))
-        docs = await app.state.db_client.find()
-        doc_ids = [str(doc["_id"]) for doc in docs]
-        texts = [convert_to_text(doc, ignore_keywords=True) for doc in docs],
-        await a_logger.info("Revectorizing {} documents...".format(len(docs)))
-        vectors = await client.vectorize(
-            app.state.db_client.vectors_coll, task_id, texts, doc_ids, logger=a_logger)
-        if vectors:
-            await app.state.vector_client._clear_up()
-            await a_logger.info("Indexing...")
-            await app.state.vector_client.insert(vectors, doc_ids)
+        total = await db_client.bntl_coll.count_documents({})
+        await a_logger.info("Revectorizing {} documents...".format(total))
+        # build a new version of the index while the current one keeps serving queries
+        version = await vector_client.create_version()
+        try:
+            n_done, projection = 0, {field: 1 for field in TEXT_FIELDS}
+            batch_id = 0
+            async for docs in db_client.iter_documents(projection=projection, batch_size=batch_size):
+                sub_task_id = "{}-{}".format(task_id, batch_id)
+                texts = [convert_to_text(doc, ignore_keywords=True) for doc in docs]
+                doc_ids = [doc["doc_id"] for doc in docs]
+                # uploads take precedence over revectorizing
+                done = await client.vectorize(
+                    sub_task_id, texts, doc_ids, priority=-1, logger=a_logger)
+                if not done:
+                    await a_logger.info("Couldn't get vectors for batch-{} during reindex operation".format(batch_id))
+                    await app.state.file_upload.update_status(task_id, Status.VECTORIZINGERROR)
+                    await vector_client.drop_version(version)
+                    return
+                await vector_client.insert_stream(
+                    add_payloads(client.download_vectors(sub_task_id), db_client),
+                    collection_name=version, logger=a_logger)
+                await client.ack_task(sub_task_id)
+                n_done += len(docs)
+                await a_logger.info("Batch-{}: revectorized {}/{} documents".format(batch_id, n_done, total))
+                await app.state.file_upload.update_status(
+                    task_id, Status.VECTORIZING, progress=min(1, n_done / max(total, 1)))
+                batch_id += 1
+            n_vectors = await vector_client.count(collection_name=version, exact=True)
+            n_docs = await db_client.bntl_coll.count_documents({})
+            if n_vectors != n_docs:
+                await a_logger.info("Vector count mismatch ({} vectors, {} documents), keeping current index".format(
+                    n_vectors, n_docs))
+                await app.state.file_upload.update_status(task_id, Status.VECTORINDEXINGERROR)
+                await vector_client.drop_version(version)
+                return
+            had_neighbors = await db_client.has_neighbors()
+            await vector_client.switch_version(version)
+            # the neighbor table was computed on the previous embeddings, drop it so that
+            # queries fall back to live search, and rebuild it from the new index
+            await db_client.neighbors_coll.drop()
             await a_logger.info("Done indexing")
-        else:
-            await a_logger.info("Couldn't get vectors during reindex operation")
+            if had_neighbors:
+                await a_logger.info("Rebuilding neighbor table...")
+                try:
+                    await neighbors.build_neighbors(db_client, vector_client, logger=a_logger)
+                except Exception as e:
+                    # the new index is in place, queries keep using live search
+                    await a_logger.info("Couldn't rebuild neighbor table: [{}]".format(str(e)))
+            await app.state.file_upload.update_status(task_id, Status.DONE)
+        except Exception as e:
+            await a_logger.info("Exception while revectorizing: [{}]".format(str(e)))
+            await app.state.file_upload.update_status(task_id, Status.UNKNOWNERROR, detail=str(e))
+            await vector_client.drop_version(version)
 
 
 @app.post("/revectorize", dependencies=[Depends(require_validated_session)])
@@ -398,40 +490,65 @@ async def get_completions(field: str, query: str=Query(..., min_length=3)):
 
 @app.get("/exportRecord")
 async def export_record(doc_id: str, format: str):
-    doc = await app.state.db_client.get_doc_source(doc_id)
-    if not doc:
+    if format not in export.FORMATS:
+        raise HTTPException(status_code=404, detail=f"Unknown format: [{format}]")
+    records = await export.get_records(app.state.db_client, [doc_id], format)
+    if not records:
         raise HTTPException(status_code=404, detail=f"Unknown document: {doc_id}")
 
-    if format == "ris":
-        output = rispy.dumps([doc])
-    elif format == "bib":
-        output = await utils.ris2bib(rispy.dumps([doc]))
-    else:
-        raise HTTPException(status_code=404, detail=f"Unknown format: [{format}]")
-    
-    return StreamingResponse(io.BytesIO(output.encode()))
+    return StreamingResponse(io.BytesIO(records[0]), media_type=export.MEDIA_TYPES[format])
 
 
 @app.get("/exportQuery")
-async def export_query(query_id: str, format: str, request: Request):
+async def export_query(query_id: str, format: str, request: Request,
+                       sort_author: Literal["ascending", "descending", ""]="",
+                       sort_year: Literal["ascending", "descending", ""]="",
+                       gzip: bool=False):
+    """
+    Export all results of a query (up to MAX_EXPORT_RESULTS, if set), optionally gzipped
+    """
     session_id = request.cookies.get("session_id")
     query_data = await app.state.db_client.get_query(query_id, session_id)
     if not query_data:
-        return HTTPException(status_code=404, detail="Query not found")
+        raise HTTPException(status_code=404, detail="Query not found")
+    if format not in export.FORMATS:
+        raise HTTPException(status_code=404, detail=f"Unknown format: [{format}]")
 
     query_params = QueryParams.model_validate(query_data['query_params'])
     query = build_query(**query_params.model_dump())
-
-    docs = await app.state.db_client.find(query, limit=settings.MAX_EXPORT_RESULTS)
-    sources = await app.state.db_client.get_docs_source([doc['doc_id'] for doc in docs])
-
-    if format == "ris":
-        output = rispy.dumps(sources)
-    elif format == "bib":
-        output = await utils.ris2bib(rispy.dumps(sources))
-    else:
-        raise HTTPException(status_code=404, detail=f"Unknown format: [{format}]")
-    return StreamingResponse(io.BytesIO(output.encode()))
+    sort = parse_sort(PageParams(sort_author=sort_author, sort_year=sort_year))
+
+    headers, media_type = {}, export.MEDIA_TYPES[format]
+    if gzip:
+        headers["Content-Disposition"] = f"attachment; filename=export.{format}.gz"
+        media_type = "application/gzip"
+    return StreamingResponse(
+        export.stream_export(app.state.db_client, query, format, sort=sort,
+                             limit=settings.MAX_EXPORT_RESULTS, compress=gzip,
+                             batch_size=settings.EXPORT_BATCH_SIZE),
+        media_type=media_type, headers=headers)
+
+
+@app.get("/dumpRecords", dependencies=[Depends(require_token)])
+async def dump_records(request: Request,
+                       query_params: QueryParams=Depends(),
+                       since: Optional[datetime]=None,
+                       after: Optional[str]=None,
+                       limit: int=0):
+    """
+    Stream the records (or those matching the query) as NDJSON, gzipped if the client
+    accepts it. Use `since` for incremental pulls (by date of ingestion) and `after`,
+    the doc_id of the last record received, to resume an interrupted dump.
+    """
+    if after is not None and not ObjectId.is_valid(after):
+        raise HTTPException(status_code=400, detail=f"Invalid cursor: {after}")
+    query = build_query(**query_params.model_dump())
+    chunks = dump.iter_dump(app.state.db_client, query, since=since, after=after, limit=limit,
+                            batch_size=settings.DUMP_BATCH_SIZE)
+    headers = {}
+    if "gzip" in request.headers.get("Accept-Encoding", ""):
+        chunks, headers["Content-Encoding"] = utils.gzip_stream(chunks), "gzip"
+    return StreamingResponse(chunks, media_type="application/x-ndjson", headers=headers)
 
 
 if __name__ == '__main__':
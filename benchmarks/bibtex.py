@@ -0,0 +1,103 @@
+import random
+import shutil
+import asyncio
+
+import rispy
+
+from bntl import utils, bibtex
+from benchmarks.utils import SEED, Timer, percentiles, report, add_arguments
+
+
+def synthetic_sources(n, seed=SEED):
+    """
+    Random records covering the reference types and fields used in the BNTL
+    """
+    rng = random.Random(seed)
+    words = ["literatuur", "roman", "poëzie", "Vondel", "Hadewijch", "renaissance", "tijdschrift",
+             "vertaling", "receptie", "Multatuli", "Max Havelaar", "kroniek", "lied", "toneel"]
+    sources = []
+    for _ in range(n):
+        type_of_reference = rng.choice(["JOUR", "BOOK", "CHAP", "EJOUR", "WEB", "JFULL", "ADVS"])
+        source = {"type_of_reference": type_of_reference,
+                  "authors": ["{}, {}.".format(rng.choice(words).title(), rng.choice("ABCDEFGH"))
+                              for _ in range(rng.randint(1, 3))],
+                  "title": " ".join(rng.choice(words) for _ in range(rng.randint(3, 12))),
+                  "year": str(rng.randint(1950, 2024)),
+                  "keywords": [rng.choice(words) for _ in range(rng.randint(0, 4))]}
+        if type_of_reference in ("JOUR", "EJOUR", "JFULL"):
+            source.update({"journal_name": rng.choice(words).title(), "volume": str(rng.randint(1, 120))})
+        else:
+            source.update({"publisher": rng.choice(words).title(), "place_published": "Amsterdam"})
+        if type_of_reference == "CHAP":
+            source.update({"secondary_title": " ".join(rng.choice(words) for _ in range(5)),
+                           "secondary_authors": ["{}, {}.".format(rng.choice(words).title(), "J")]})
+        if type_of_reference in ("JOUR", "CHAP", "JFULL"):
+            start_page = rng.randint(1, 400)
+            source.update({"start_page": str(start_page), "end_page": str(start_page + rng.randint(1, 30))})
+        sources.append(source)
+    return sources
+
+
+async def native(sources):
+    return bibtex.dumps(sources)
+
+
+async def subprocess(sources):
+    return await utils.ris2bib(rispy.dumps(sources))
+
+
+async def run(method, sources, n_requests, records, concurrency):
+    """
+    Latency of single requests of `records` records and throughput of `concurrency`
+    requests at a time
+    """
+    latencies = []
+    for i in range(n_requests):
+        batch = sources[(i * records) % len(sources):][:records]
+        with Timer() as timer:
+            await method(batch)
+        latencies.append(timer.elapsed)
+
+    with Timer() as timer:
+        await asyncio.gather(*[method(sources[:records]) for _ in range(concurrency)])
+
+    return {**percentiles(latencies, unit="ms"),
+            "concurrent_secs": timer.elapsed,
+            "requests_per_sec": concurrency / timer.elapsed}
+
+
+async def main(args):
+    if args.ris:
+        with open(args.ris) as f:
+            sources = rispy.load(f)
+    else:
+        sources = synthetic_sources(args.n, seed=args.seed)
+
+    methods = {"native": native}
+    if shutil.which("ris2xml") and shutil.which("xml2bib"):
+        methods["subprocess"] = subprocess
+    else:
+        print("bibutils not found, only benchmarking the native converter")
+
+    results = []
+    for records in args.records:
+        for name, method in methods.items():
+            results.append({"method": name, "records": records,
+                            **await run(method, sources, args.requests, records, args.concurrency)})
+
+    report(results, output=args.output)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Compare the native BibTeX converter with the bibutils subprocess pipeline")
+    parser.add_argument('--ris', help="Path to a RIS file (defaults to synthetic records)")
+    parser.add_argument('--n', type=int, default=10_000, help="Number of synthetic records")
+    parser.add_argument('--records', type=int, nargs='+', default=[1, 100, 1_000],
+                        help="Number of records per request")
+    parser.add_argument('--requests', type=int, default=50)
+    parser.add_argument('--concurrency', type=int, default=20)
+    add_arguments(parser)
+    args = parser.parse_args()
+    asyncio.run(main(args))
@@ -0,0 +1,160 @@
+import asyncio
+
+import numpy as np
+from qdrant_client import AsyncQdrantClient
+from qdrant_client import models
+
+from bntl.settings import settings
+from bntl.vector import collection_config, search_params
+from benchmarks.utils import SEED, Timer, percentiles, report, add_arguments
+
+
+def synthetic_vectors(n, dim, n_clusters=100, noise=0.5, seed=SEED):
+    """
+    Clustered gaussian vectors, which are closer to the structure of real embeddings than
+    uniform noise (on which all approximate indices look bad)
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(n_clusters, dim)).astype(np.float32)
+    vectors = centers[rng.integers(n_clusters, size=n)] + noise * rng.normal(size=(n, dim)).astype(np.float32)
+    return vectors
+
+
+def normalize(vectors):
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+
+def exact_topk(vectors, query_idxs, k, block_size=4096):
+    """
+    Ground truth neighbors for the queries (excluding the queries themselves)
+    """
+    queries = vectors[query_idxs]
+    truth = []
+    for start in range(0, len(queries), block_size):
+        sims = queries[start:start + block_size] @ vectors.T
+        sims[np.arange(len(sims)), query_idxs[start:start + block_size]] = -np.inf
+        top = np.argpartition(-sims, k, axis=1)[:, :k]
+        truth.extend(set(row) for row in top)
+    return truth
+
+
+def estimate_ram(profile, n, dim):
+    """
+    Rough estimate of the RAM used by a collection: original vectors, quantized vectors
+    and HNSW links (2 * m links of 4 bytes per point in the base layer)
+    """
+    ram = 0 if profile.on_disk else n * dim * 4
+    if profile.quantization == "scalar" and profile.quantization_always_ram:
+        ram += n * dim
+    elif profile.quantization == "binary" and profile.quantization_always_ram:
+        ram += n * dim // 8
+    if not profile.hnsw_on_disk:
+        ram += n * profile.hnsw_m * 2 * 4
+    return ram
+
+
+def get_rss(pid):
+    """
+    Resident memory of a process in bytes (Linux only)
+    """
+    with open("/proc/{}/status".format(pid)) as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+
+
+async def wait_indexed(client, collection_name, n_points, poll=1):
+    """
+    Wait until all points are stored and indexed (the collection may report GREEN
+    before the queued updates have been applied)
+    """
+    while True:
+        info = await client.get_collection(collection_name)
+        if info.status == models.CollectionStatus.GREEN and info.points_count == n_points:
+            return
+        await asyncio.sleep(poll)
+
+
+async def run_profile(client, name, profile, vectors, query_idxs, truth, k, batch_size=500, qdrant_pid=None):
+    collection_name = "benchmark-{}".format(name)
+    if await client.collection_exists(collection_name):
+        await client.delete_collection(collection_name)
+    rss_before = get_rss(qdrant_pid) if qdrant_pid else None
+    await client.create_collection(collection_name=collection_name, **collection_config(profile, vectors.shape[1]))
+
+    with Timer() as index_timer:
+        for i in range(0, len(vectors), batch_size):
+            await client.upsert(
+                collection_name=collection_name,
+                points=models.Batch(ids=list(range(i, min(i + batch_size, len(vectors)))),
+                                    vectors=vectors[i:i + batch_size].tolist()),
+                # the last batch waits for all queued updates to be applied
+                wait=i + batch_size >= len(vectors))
+        await wait_indexed(client, collection_name, len(vectors))
+
+    latencies, recalls = [], []
+    params = search_params(profile)
+    for query_idx, expected in zip(query_idxs, truth):
+        with Timer() as timer:
+            hits = await client.search(
+                collection_name=collection_name,
+                query_vector=vectors[query_idx].tolist(),
+                query_filter=models.Filter(must_not=[models.HasIdCondition(has_id=[int(query_idx)])]),
+                limit=k,
+                search_params=params,
+                with_payload=False)
+        latencies.append(timer.elapsed)
+        recalls.append(len(expected & {hit.id for hit in hits}) / k)
+
+    result = {"profile": name,
+              "recall@k": float(np.mean(recalls)),
+              **percentiles(latencies, unit="ms"),
+              "index_secs": index_timer.elapsed,
+              "estimated_ram_mb": estimate_ram(profile, *vectors.shape) / 2 ** 20}
+    if qdrant_pid:
+        result["rss_delta_mb"] = (get_rss(qdrant_pid) - rss_before) / 2 ** 20
+    await client.delete_collection(collection_name)
+    return result
+
+
+async def main(args):
+    if args.vectors:
+        vectors = np.load(args.vectors, mmap_mode="r")
+        vectors = np.asarray(vectors[:args.n] if args.n else vectors, dtype=np.float32)
+    else:
+        vectors = synthetic_vectors(args.n or 100_000, args.dim)
+    vectors = normalize(vectors)
+    rng = np.random.default_rng(args.seed)
+    query_idxs = rng.choice(len(vectors), min(args.queries, len(vectors)), replace=False)
+    print("Computing exact neighbors for {} queries over {} vectors...".format(len(query_idxs), len(vectors)))
+    truth = exact_topk(vectors, query_idxs, args.k)
+
+    client = AsyncQdrantClient(location="localhost", port=settings.QDRANT_PORT, timeout=100)
+    results = []
+    try:
+        for name in args.profiles or list(settings.QDRANT_PROFILES):
+            print("Running profile: {}".format(name))
+            results.append(await run_profile(
+                client, name, settings.QDRANT_PROFILES[name], vectors, query_idxs, truth, args.k,
+                qdrant_pid=args.qdrant_pid))
+    finally:
+        await client.close()
+
+    report(results, output=args.output)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Measure recall@k (against exact NumPy search), latency and memory of the QDrant tuning profiles")
+    parser.add_argument('--vectors', help="Path to a .npy file with vectors (e.g. an export of the vector database)")
+    parser.add_argument('--n', type=int, help="Number of vectors to use (defaults to all or 100k synthetic)")
+    parser.add_argument('--dim', type=int, default=1024, help="Dimension of the synthetic vectors")
+    parser.add_argument('--queries', type=int, default=1_000)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--profiles', nargs='+', help="Profiles to benchmark (defaults to all)")
+    parser.add_argument('--qdrant-pid', type=int, default=None, help="Measure the RSS of the QDrant process")
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    asyncio.run(main(args))
@@ -0,0 +1,80 @@
+import random
+
+from bntl import utils
+from bntl.models import DocScreen, format_str_from_ris
+from benchmarks.utils import SEED, Timer, percentiles, report, add_arguments
+
+
+def legacy_render(doc):
+    """
+    Rendering as done before templates were compiled (as reference)
+    """
+    repr_str = format_str_from_ris(DocScreen.get_repr_str(doc))
+    kwargs = {k: utils.maybe_list(v) for k, v in doc.items()}
+    return repr_str.format_map(kwargs)
+
+
+def synthetic_docs(n, seed=SEED):
+    """
+    Random documents of all reference types, with the fields of their screen representation
+    plus the extra fields stored in the database
+    """
+    rng = random.Random(seed)
+    words = ["literatuur", "roman", "poëzie", "Vondel", "Hadewijch", "renaissance", "tijdschrift",
+             "vertaling", "receptie", "Multatuli", "kroniek", "lied", "toneel"]
+    types = ["JOUR", "BOOK", "CHAP", "EJOUR", "WEB", "JFULL", "ADVS"]
+    docs = []
+    for _ in range(n):
+        doc = {"type_of_reference": rng.choice(types),
+               "keywords": [rng.choice(words) for _ in range(rng.randint(1, 5))],
+               "date_added": "2024-01-01", "hash": "0" * 32, "doc_id": "0" * 24}
+        if doc["type_of_reference"] == "BOOK" and rng.random() < 0.3:
+            doc["secondary_authors"] = ["{}, J.".format(rng.choice(words).title())]
+        for fname in DocScreen.get_screen(doc).fields:
+            if fname.endswith("authors"):
+                doc[fname] = ["{}, {}.".format(rng.choice(words).title(), rng.choice("ABCDEFGH"))
+                              for _ in range(rng.randint(1, 3))]
+            else:
+                doc[fname] = " ".join(rng.choice(words) for _ in range(rng.randint(1, 8)))
+        docs.append(doc)
+    return docs
+
+
+def run(method, docs, page_size, repeats):
+    """
+    Time per item of rendering pages of `page_size` documents
+    """
+    timings = []
+    for _ in range(repeats):
+        for start in range(0, len(docs), page_size):
+            page = docs[start:start + page_size]
+            with Timer() as timer:
+                for doc in page:
+                    method(doc)
+            timings.append(timer.elapsed / len(page))
+    return percentiles(timings, unit="us")
+
+
+def main(args):
+    docs = synthetic_docs(args.n, seed=args.seed)
+    for doc in docs:
+        assert DocScreen.render_doc(doc) == legacy_render(doc)
+
+    results = []
+    for name, method in [("legacy", legacy_render), ("compiled", DocScreen.render_doc),
+                         ("missing_fields", DocScreen.find_missing_fields)]:
+        results.append({"method": name, "page_size": args.page_size,
+                        **run(method, docs, args.page_size, args.repeats)})
+
+    report(results, output=args.output)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmark the rendering of documents in results pages")
+    parser.add_argument('--n', type=int, default=10_000, help="Number of synthetic documents")
+    parser.add_argument('--page-size', type=int, default=100)
+    parser.add_argument('--repeats', type=int, default=5)
+    add_arguments(parser)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,51 @@
+import time
+import json
+
+import numpy as np
+
+
+SEED = 1001
+
+UNITS = {"secs": 1, "ms": 1e3, "us": 1e6}
+
+
+class Timer:
+    """
+    Measure the wall time of a block (`elapsed`, in secs)
+    """
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.elapsed = time.perf_counter() - self.start
+
+
+def percentiles(timings, unit="ms", percentiles=(50, 99)):
+    """
+    Summary of a list of timings (in secs) as {"p50_ms": ..., "p99_ms": ...}
+    """
+    return {"p{}_{}".format(p, unit): float(np.percentile(timings, p) * UNITS[unit]) for p in percentiles}
+
+
+def report(results, output=None):
+    """
+    Print the results as a table and optionally store them in json format
+    """
+    header = list(dict.fromkeys(key for result in results for key in result))
+    print("\t".join(header))
+    for result in results:
+        value = [result.get(key, "") for key in header]
+        print("\t".join(str(round(item, 3)) if isinstance(item, float) else str(item) for item in value))
+    if output:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+def add_arguments(parser):
+    """
+    Arguments shared by all benchmarks
+    """
+    parser.add_argument('--output', help="Path to store the results in json format")
+    parser.add_argument('--seed', type=int, default=SEED)
+    return parser
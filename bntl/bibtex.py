@@ -0,0 +1,156 @@
+import re
+import unicodedata
+from collections import Counter
+from typing import List, Dict, Iterable, Iterator, Union
+
+from bntl.csl import get_notes
+
+
+# RIS reference type -> BibTeX entry type
+TYPE_MAPPING = {
+    "JOUR": "article",
+    "EJOUR": "article",
+    "BOOK": "book",
+    "CHAP": "incollection",
+    "JFULL": "misc",
+    "WEB": "misc",
+    "ADVS": "misc",
+}
+
+# parsed RIS field -> BibTeX field, in output order. Fields whose BibTeX name depends
+# on the reference type are resolved in `get_fields`
+FIELD_MAPPING = {
+    "authors": "author",
+    "first_authors": "author",
+    "secondary_authors": "editor",
+    "title": "title",
+    "secondary_title": "booktitle",
+    "journal_name": "journal",
+    "year": "year",
+    "volume": "volume",
+    "number": "number",
+    "edition": "edition",
+    "publisher": "publisher",
+    "place_published": "address",
+    "issn": "issn",
+    "urls": "url",
+    "keywords": "keywords",
+    "abstract": "abstract",
+    "notes": "note", # N1 and M1, see `get_notes`
+}
+# fields written verbatim (escaping would break links)
+VERBATIM_FIELDS = {"url"}
+
+# secondary titles are the journal name for articles
+JOURNAL_TYPES = {"JOUR", "EJOUR", "JFULL"}
+# the SN field holds the ISBN for books
+ISBN_TYPES = {"BOOK", "CHAP"}
+
+LATEX_ESCAPES = {"\\": r"\textbackslash{}", "~": r"\textasciitilde{}", "^": r"\textasciicircum{}",
+                 **{char: "\\" + char for char in "&%$#_{}"}}
+# a single pass, so that the output of an escape isn't escaped again
+LATEX_SPECIAL = re.compile("|".join(map(re.escape, LATEX_ESCAPES)))
+
+
+def escape(value: str) -> str:
+    return LATEX_SPECIAL.sub(lambda match: LATEX_ESCAPES[match.group()], value.strip())
+
+
+def join_values(field: str, value: Union[str, List[str]]) -> str:
+    if not isinstance(value, list):
+        return str(value)
+    if field in ("author", "editor"):
+        return " and ".join(value)
+    if field == "url":
+        return " ".join(value)
+    if field == "note":
+        return "; ".join(value)
+    return ", ".join(value)
+
+
+def get_fields(source: Dict) -> Dict[str, str]:
+    """
+    BibTeX fields of a parsed RIS record (unescaped)
+    """
+    type_of_reference = source.get("type_of_reference")
+    fields = {}
+    for key, field in FIELD_MAPPING.items():
+        value = get_notes(source) if key == "notes" else source.get(key)
+        if not value:
+            continue
+        if key == "secondary_title" and type_of_reference in JOURNAL_TYPES:
+            field = "journal"
+        elif key == "issn" and type_of_reference in ISBN_TYPES:
+            field = "isbn"
+        if field in fields: # e.g. AU and A1 or JO and T2
+            continue
+        fields[field] = join_values(field, value)
+    start_page, end_page = source.get("start_page"), source.get("end_page")
+    if start_page and end_page:
+        fields["pages"] = "{}--{}".format(start_page, end_page)
+    elif start_page or end_page:
+        fields["pages"] = start_page or end_page
+    return fields
+
+
+def ascii_fold(text: str) -> str:
+    return unicodedata.normalize("NFKD", text).encode("ascii", "ignore").decode()
+
+
+def make_key(source: Dict, keys: Counter) -> str:
+    """
+    Citation key from the last name of the first author (or editor) and the year,
+    with a suffix to make it unique among the `keys` used so far
+    """
+    names = source.get("authors") or source.get("first_authors") or source.get("secondary_authors") or []
+    name = names[0].split(",")[0] if names else (source.get("title") or "").split(" ")[0]
+    key = re.sub(r"[^A-Za-z0-9]", "", ascii_fold(name)) or "ref"
+    key += re.sub(r"[^0-9]", "", str(source.get("year") or ""))[:4]
+    return unique_key(key, keys)
+
+
+def unique_key(key: str, keys: Counter) -> str:
+    keys[key] += 1
+    if keys[key] > 1:
+        key += "-{}".format(keys[key] - 1)
+    return key
+
+
+def rekey(entry: str, keys: Counter) -> str:
+    """
+    Make the citation key of a rendered entry unique among `keys` (entries are rendered
+    on their own at ingestion, so keys may collide once they are concatenated)
+    """
+    head, rest = entry.split(",", 1)
+    entry_type, key = head.split("{", 1)
+    return "{}{{{},{}".format(entry_type, unique_key(key, keys), rest)
+
+
+def dump(source: Dict, keys: Union[None, Counter]=None) -> str:
+    """
+    Render a parsed RIS record as a BibTeX entry
+    """
+    keys = keys if keys is not None else Counter()
+    entry_type = TYPE_MAPPING.get(source.get("type_of_reference"), "misc")
+    fields = get_fields(source)
+    width = max(map(len, fields), default=0)
+    lines = ["@{}{{{},".format(entry_type, make_key(source, keys))]
+    for field, value in fields.items():
+        value = value.strip() if field in VERBATIM_FIELDS else escape(value)
+        lines.append("  {} = {{{}}},".format(field.ljust(width), value))
+    lines.append("}\n")
+    return "\n".join(lines)
+
+
+def iter_dumps(sources: Iterable[Dict], keys: Union[None, Counter]=None) -> Iterator[str]:
+    """
+    Render records one by one. Pass the same `keys` across calls to keep citation keys
+    unique over several batches
+    """
+    keys = keys if keys is not None else Counter()
+    for source in sources:
+        yield dump(source, keys)
+
+
+def dumps(sources: Iterable[Dict], keys: Union[None, Counter]=None) -> str:
+    return "\n".join(iter_dumps(sources, keys))
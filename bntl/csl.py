@@ -0,0 +1,86 @@
+import re
+from typing import List, Dict
+
+
+# RIS reference type -> CSL type
+TYPE_MAPPING = {
+    "JOUR": "article-journal",
+    "EJOUR": "article-journal",
+    "BOOK": "book",
+    "CHAP": "chapter",
+    "JFULL": "periodical",
+    "WEB": "webpage",
+    "ADVS": "motion_picture",
+}
+
+# parsed RIS field -> CSL variable (string variables only)
+FIELD_MAPPING = {
+    "title": "title",
+    "journal_name": "container-title",
+    "secondary_title": "container-title",
+    "volume": "volume",
+    "number": "issue",
+    "edition": "edition",
+    "publisher": "publisher",
+    "place_published": "publisher-place",
+    "abstract": "abstract",
+}
+
+# the SN field holds the ISBN for books
+ISBN_TYPES = {"BOOK", "CHAP"}
+
+
+def parse_name(name: str) -> Dict[str, str]:
+    """
+    CSL name from a "Last, First" name (names without comma are kept as literals)
+    """
+    if "," not in name:
+        return {"literal": name.strip()}
+    family, given = name.split(",", 1)
+    return {"family": family.strip(), "given": given.strip()}
+
+
+def parse_names(names: List[str]) -> List[Dict[str, str]]:
+    return [parse_name(name) for name in names if name and name.strip()]
+
+
+def get_notes(source: Dict) -> List[str]:
+    """
+    Notes (N1) followed by the miscellaneous note (M1), if any
+    """
+    notes = list(source.get("notes") or [])
+    return notes + [source["note"]] if source.get("note") else notes
+
+
+def dump(source: Dict) -> Dict:
+    """
+    Render a parsed RIS record as a CSL-JSON item
+    """
+    type_of_reference = source.get("type_of_reference")
+    item = {"type": TYPE_MAPPING.get(type_of_reference, "document")}
+    for key, variable in FIELD_MAPPING.items():
+        if source.get(key) and variable not in item:
+            item[variable] = source[key]
+    authors = source.get("authors") or source.get("first_authors")
+    if authors:
+        item["author"] = parse_names(authors)
+    if source.get("secondary_authors"):
+        item["editor"] = parse_names(source["secondary_authors"])
+    year = re.match(r"\d{4}", str(source.get("year") or ""))
+    if year:
+        item["issued"] = {"date-parts": [[int(year.group())]]}
+    start_page, end_page = source.get("start_page"), source.get("end_page")
+    if start_page and end_page:
+        item["page"] = "{}-{}".format(start_page, end_page)
+    elif start_page or end_page:
+        item["page"] = start_page or end_page
+    if source.get("issn"):
+        item["ISBN" if type_of_reference in ISBN_TYPES else "ISSN"] = source["issn"]
+    if source.get("urls"):
+        item["URL"] = source["urls"][0]
+    notes = get_notes(source)
+    if notes:
+        item["note"] = "; ".join(notes)
+    if source.get("keywords"):
+        item["keyword"] = ", ".join(source["keywords"])
+    return item
@@ -14,10 +14,9 @@ from pymongo import InsertOne
 import motor.motor_asyncio as motor
 
 from bntl.settings import settings
-from bntl import utils
+from bntl import utils, export
 from bntl.models import QueryModel, QueryParams, StatusModel, EntryModel
 
-from vectorizer.settings import settings as v_settings
 
 
 logger = logging.getLogger(__name__)
@@ -118,8 +117,7 @@ class DBClient():
         self.autocomplete_coll = self.mongodb_client[settings.BNTL_DB][settings.AUTOCOMPLETE_COLL]
         self.query_coll = self.mongodb_client[settings.LOCAL_DB][settings.QUERY_COLL]
         self.upload_coll = self.mongodb_client[settings.LOCAL_DB][settings.UPLOAD_COLL]
-        # vectorize database to retrieve vectors when done
-        self.vectors_coll = self.mongodb_client[v_settings.VECTORIZER_DB][v_settings.VECTORS_COLL]
+        self.neighbors_coll = self.mongodb_client[settings.LOCAL_DB][settings.NEIGHBORS_COLL]
 
     @classmethod
     async def create(cls):
@@ -133,12 +131,14 @@ class DBClient():
         logger.info("Creating DB indices")
         await self.bntl_coll.create_index("hash", unique=True)
         await self.source_coll.create_index("doc_id", unique=True)
+        await self.bntl_coll.create_index("date_added")
         # ensure text search index
         await self.bntl_coll.create_index({"$**": "text"})
         await self.autocomplete_coll.create_index(("field", "value"), unique=True)
         await self.autocomplete_coll.create_index({"field": "text", "value": "text"})
         # ensure index on file_id (this may generate collisions)
         await self.upload_coll.create_index("file_id", unique=True)
+        await self.neighbors_coll.create_index("doc_id", unique=True)
     
     async def count(self):
         return await self.bntl_coll.estimated_document_count()
@@ -205,7 +205,9 @@ class DBClient():
                 done.extend([str(item["doc"]["_id"]) for idx, item in enumerate(docs) if idx not in errors])
                 
                 # index source documents
-                source_docs = [InsertOne({"doc_id": str(item["doc"]["_id"]), "source": item["source"]}) 
+                source_docs = [InsertOne({"doc_id": str(item["doc"]["_id"]),
+                                          "source": item["source"],
+                                          "artifacts": export.render_artifacts(item["source"])})
                                for idx, item in enumerate(docs) if idx not in errors]
                 try:
                     if source_docs:
@@ -238,6 +240,40 @@ class DBClient():
             item['doc_id'] = str(item.pop("_id"))
         return results
 
+    async def iter_documents(self, query=None, projection=None, batch_size=1_000, after=None):
+        """
+        Stream documents in batches. Batches are fetched by ranges of _id instead of keeping
+        a cursor open, so that consumers can take their time in between batches. Pass the
+        doc_id of the last document seen as `after` to resume a previous stream.
+        """
+        query, last_id = query or {}, ObjectId(after) if after else None
+        while True:
+            batch_query = query if last_id is None else {"$and": [query, {"_id": {"$gt": last_id}}]}
+            batch = await self.bntl_coll.find(batch_query, projection).sort(
+                "_id", pymongo.ASCENDING).limit(batch_size).to_list(length=None)
+            if not batch:
+                break
+            last_id = batch[-1]["_id"]
+            for item in batch:
+                item['doc_id'] = str(item.pop("_id"))
+            yield batch
+
+    async def find_by_ids(self, doc_ids: List[str], projection=None) -> List[Optional[Dict]]:
+        """
+        Retrieve documents by id, in the same order as the input ids (None for missing ids)
+        """
+        items = await self.bntl_coll.find(
+            {"_id": {"$in": [ObjectId(doc_id) for doc_id in doc_ids]}}, projection
+        ).to_list(length=None)
+        items = {str(item["_id"]): item for item in items}
+        output = []
+        for doc_id in doc_ids:
+            item = items.get(doc_id)
+            if item is not None:
+                item = {"doc_id": doc_id, **{k: v for k, v in item.items() if k != "_id"}}
+            output.append(item)
+        return output
+
     async def find_one(self, doc_id):
         item = await self.bntl_coll.find_one({"_id": ObjectId(doc_id)})
         if item:
@@ -260,8 +296,37 @@ class DBClient():
         return doc["source"]
 
     async def get_docs_source(self, doc_ids: List[str]) -> List[Dict]:
-        docs = await self.source_coll.find({"doc_id": {"$in": doc_ids}}).to_list(length=None)
-        return [doc["source"] for doc in docs]
+        """
+        Sources of the given documents, in the same order (missing documents are skipped)
+        """
+        docs = await self.source_coll.find(
+            {"doc_id": {"$in": doc_ids}}, {"_id": 0, "doc_id": 1, "source": 1}).to_list(length=None)
+        sources = {doc["doc_id"]: doc["source"] for doc in docs}
+        return [sources[doc_id] for doc_id in doc_ids if doc_id in sources]
+
+    async def get_docs_artifacts(self, doc_ids: List[str], format: str) -> Dict[str, Optional[bytes]]:
+        """
+        Compressed serializations of the given documents in a format (None for documents
+        ingested without them, missing documents are skipped)
+        """
+        docs = await self.source_coll.find(
+            {"doc_id": {"$in": doc_ids}}, {"_id": 0, "doc_id": 1, "artifacts." + format: 1}).to_list(length=None)
+        return {doc["doc_id"]: doc.get("artifacts", {}).get(format) for doc in docs}
+
+    # neighbor table
+    async def find_neighbors(self, doc_id: str, limit: int) -> Optional[List[Dict]]:
+        """
+        Retrieve the precomputed neighbors of a document. Returns None if the table
+        doesn't hold (enough) neighbors for it.
+        """
+        item = await self.neighbors_coll.find_one(
+            {"doc_id": doc_id}, {"neighbors": {"$slice": limit}, "scores": {"$slice": limit}})
+        if not item or len(item["neighbors"]) < limit:
+            return
+        return [{"doc_id": neighbor, "score": score} for neighbor, score in zip(item["neighbors"], item["scores"])]
+
+    async def has_neighbors(self) -> bool:
+        return (await self.neighbors_coll.estimated_document_count()) > 0
 
     # query collection
     async def get_session_queries(self, session_id) -> List[QueryModel]:
@@ -336,6 +401,7 @@ class DBClient():
         await self.query_coll.drop()
         await self.upload_coll.drop()
         await self.source_coll.drop()
+        await self.neighbors_coll.drop()
         # ensure we recreate the indices
         await self.ensure_indices()
 
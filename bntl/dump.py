@@ -0,0 +1,32 @@
+from datetime import datetime
+from typing import Optional, AsyncIterator
+
+import orjson
+
+
+def dumps_line(obj) -> bytes:
+    """
+    Serialize an object as a line of NDJSON (datetimes as RFC 3339, other unsupported
+    types such as ObjectIds as strings)
+    """
+    return orjson.dumps(obj, default=str, option=orjson.OPT_APPEND_NEWLINE)
+
+
+async def iter_dump(db_client, query=None, since: Optional[datetime]=None, after: Optional[str]=None,
+                    limit: int=0, batch_size: int=1_000) -> AsyncIterator[bytes]:
+    """
+    Stream the documents matching `query` as NDJSON in batches, in order of doc_id. Use
+    `since` to only get the documents added since a date and `after` (the doc_id of the
+    last line received) to resume an interrupted dump.
+    """
+    query = query or {}
+    if since is not None:
+        query = {"$and": [query, {"date_added": {"$gte": since}}]}
+    n_docs = 0
+    async for batch in db_client.iter_documents(query, batch_size=batch_size, after=after):
+        if limit:
+            batch = batch[:limit - n_docs]
+        n_docs += len(batch)
+        yield b"".join(dumps_line(doc) for doc in batch)
+        if limit and n_docs >= limit:
+            break
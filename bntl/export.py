@@ -0,0 +1,150 @@
+import zlib
+import json
+import asyncio
+import logging
+from collections import Counter
+from typing import List, Dict, Union, AsyncIterator
+
+import pymongo
+from pymongo import UpdateOne
+import rispy
+
+from bntl import bibtex, csl, utils
+
+
+logger = logging.getLogger(__name__)
+
+
+FORMATS = ("ris", "bib", "csl")
+
+MEDIA_TYPES = {"ris": "text/plain", "bib": "text/plain", "csl": "application/json"}
+
+
+def render_record(source: Dict, format: str) -> bytes:
+    """
+    Serialize a single source in the given format
+    """
+    if format == "ris":
+        return rispy.dumps([source]).encode()
+    elif format == "bib":
+        return bibtex.dump(source).encode()
+    elif format == "csl":
+        return json.dumps(csl.dump(source), ensure_ascii=False).encode()
+    raise ValueError(f"Unknown format: [{format}]")
+
+
+def render_artifacts(source: Dict) -> Dict[str, bytes]:
+    """
+    Compressed serializations of a source in all export formats. Records don't change
+    after ingestion, so these are computed once and stored next to the source.
+    """
+    return {format: zlib.compress(render_record(source, format)) for format in FORMATS}
+
+
+async def get_records(db_client, doc_ids: List[str], format: str) -> List[bytes]:
+    """
+    Serialized records of the given documents, in the same order. Records ingested
+    before artifacts were stored are rendered from their source.
+    """
+    artifacts = await db_client.get_docs_artifacts(doc_ids, format)
+    missing = [doc_id for doc_id, artifact in artifacts.items() if artifact is None]
+    if missing:
+        sources = await db_client.get_docs_source(missing)
+        for doc_id, source in zip(missing, sources):
+            artifacts[doc_id] = zlib.compress(render_record(source, format))
+    return [zlib.decompress(artifacts[doc_id]) for doc_id in doc_ids if doc_id in artifacts]
+
+
+async def iter_records(db_client, query, format, sort=None, limit=0, batch_size=500) -> AsyncIterator[List[bytes]]:
+    """
+    Stream the serialized records of the documents matching `query` in batches, in result
+    order. Only ids are read from the results cursor, and records are fetched per batch.
+    """
+    cursor = db_client.bntl_coll.find(query, {"_id": 1}, limit=limit)
+    cursor = cursor.sort(sort or [("year", pymongo.DESCENDING)]).batch_size(batch_size)
+    doc_ids = []
+    async for item in cursor:
+        doc_ids.append(str(item["_id"]))
+        if len(doc_ids) == batch_size:
+            yield await get_records(db_client, doc_ids, format)
+            doc_ids = []
+    if doc_ids:
+        yield await get_records(db_client, doc_ids, format)
+
+
+def join_records(records: List[bytes], format: str, keys: Union[None, Counter]=None, first=True) -> bytes:
+    """
+    Concatenate serialized records (`keys` keeps BibTeX citation keys unique across calls)
+    """
+    if format == "bib":
+        keys = keys if keys is not None else Counter()
+        records = [bibtex.rekey(record.decode(), keys).encode() for record in records]
+    sep = b",\n" if format == "csl" else b"\n"
+    return (b"" if first else sep) + sep.join(records)
+
+
+async def iter_export(db_client, query, format, sort=None, limit=0, batch_size=500) -> AsyncIterator[bytes]:
+    """
+    Concatenate the stored records of the results of a query batch by batch, so that
+    memory use doesn't depend on the number of results
+    """
+    if format == "csl":
+        yield b"["
+    first, keys = True, Counter()
+    async for records in iter_records(db_client, query, format, sort=sort, limit=limit, batch_size=batch_size):
+        if not records:
+            continue
+        yield join_records(records, format, keys=keys, first=first)
+        first = False
+    if format == "csl":
+        yield b"]"
+
+
+def stream_export(db_client, query, format, sort=None, limit=0, compress=False, batch_size=500):
+    """
+    Export the results of a query, optionally as a gzip stream
+    """
+    chunks = iter_export(db_client, query, format, sort=sort, limit=limit, batch_size=batch_size)
+    return utils.gzip_stream(chunks) if compress else chunks
+
+
+async def backfill_artifacts(db_client, batch_size=1_000, force=False):
+    """
+    Store the artifacts of records ingested before they were precomputed (or of all
+    records with `force`, e.g. after changing the serialization)
+    """
+    query = {} if force else {"artifacts": {"$exists": False}}
+    cursor = db_client.source_coll.find(query, {"_id": 1, "source": 1})
+    updates, done = [], 0
+    async for item in cursor.batch_size(batch_size):
+        updates.append(UpdateOne({"_id": item["_id"]}, {"$set": {"artifacts": render_artifacts(item["source"])}}))
+        if len(updates) == batch_size:
+            await db_client.source_coll.bulk_write(updates, ordered=False)
+            done, updates = done + len(updates), []
+            logger.info("Stored artifacts for {} records".format(done))
+    if updates:
+        await db_client.source_coll.bulk_write(updates, ordered=False)
+        done += len(updates)
+    return done
+
+
+if __name__ == '__main__':
+    import argparse
+    from bntl.db import DBClient
+    from bntl.settings import setup_logger
+
+    parser = argparse.ArgumentParser(description="Precompute the export artifacts of existing records")
+    parser.add_argument('--batch-size', type=int, default=1_000)
+    parser.add_argument('--force', action='store_true', help="Re-render the artifacts of all records")
+    args = parser.parse_args()
+
+    async def main():
+        setup_logger()
+        db_client = await DBClient.create()
+        try:
+            done = await backfill_artifacts(db_client, batch_size=args.batch_size, force=args.force)
+            logger.info("Stored artifacts for {} records".format(done))
+        finally:
+            db_client.close()
+
+    asyncio.run(main())
@@ -0,0 +1,425 @@
+import os
+import copy
+import json
+import time
+import shutil
+import asyncio
+import logging
+from datetime import datetime, timezone
+from typing import List, Dict
+
+import numpy as np
+
+from bntl.settings import settings
+from bntl import utils
+from bntl.vector import MissingVectorException
+
+
+logger = logging.getLogger(__name__)
+
+
+DTYPES = {"float16": np.float16, "int8": np.int8}
+MISSING_YEAR = np.iinfo(np.int32).min
+MISSING_TYPE = np.iinfo(np.uint8).max
+
+
+class MemmapVectorClient:
+    """
+    In-process vector index over memory-mapped files, exposing the same interface as the
+    QDrant-based `VectorClient`. Vectors are L2-normalized and stored as a (capacity, dim)
+    float16 or int8 matrix (the latter with per-row scales), next to a file mapping row
+    numbers to document ids. Search is exact by default, or IVF-style approximate
+    (probing `nprobe` k-means cells) once `train_ivf` has been run.
+
+    Files inside `path`:
+    - meta.json: dimension, dtype, number of stored vectors and reference type codes
+    - vectors.npy: memory-mapped vector matrix
+    - scales.npy: per-row scales (int8 only)
+    - types.npy, years.npy: filterable payload fields (type of reference, year and end year)
+    - doc_ids.txt: one doc_id per row
+    - ivf.npz: k-means centroids and row assignments (optional)
+    """
+    def __init__(self, path=None, dtype=None, nprobe=None, block_size=65_536) -> None:
+        self.path = path or settings.VECTOR_INDEX_DIR
+        self.dtype = dtype or settings.VECTOR_INDEX_DTYPE
+        self.nprobe = settings.VECTOR_INDEX_NPROBE if nprobe is None else nprobe
+        self.block_size = block_size
+        self.staging = None # index version being built, it also receives all new insertions
+        self.lock = asyncio.Lock()
+        self.load()
+
+    # files
+    def file(self, name):
+        return os.path.join(self.path, name)
+
+    def arrays(self, dim=None, dtype=None):
+        """
+        Name, row shape, dtype and fill value of the memory-mapped arrays
+        """
+        dim, dtype = dim or self.dim, dtype or self.dtype
+        arrays = [("vectors", (dim,), DTYPES[dtype], 0),
+                  ("types", (), np.uint8, MISSING_TYPE),
+                  ("years", (2,), np.int32, MISSING_YEAR)]
+        if dtype == "int8":
+            arrays.append(("scales", (), np.float32, 0))
+        return arrays
+
+    def read_state(self) -> Dict:
+        """
+        Read the index from disk (as a dictionary of attributes)
+        """
+        state = {"dim": None, "size": 0, "type_codes": [], "vectors": None, "scales": None,
+                 "types": None, "years": None, "centroids": None, "assignments": None,
+                 "doc_ids": [], "id_map": {}}
+        if not os.path.isfile(self.file("meta.json")):
+            return state
+        with open(self.file("meta.json")) as f:
+            meta = json.load(f)
+        state.update(dim=meta["dim"], size=meta["size"], dtype=meta["dtype"], type_codes=meta.get("type_codes", []))
+        for name, *_ in self.arrays(meta["dim"], meta["dtype"]):
+            if os.path.isfile(self.file(name + ".npy")):
+                state[name] = np.load(self.file(name + ".npy"), mmap_mode="r+")
+        with open(self.file("doc_ids.txt")) as f:
+            state["doc_ids"] = f.read().split("\n")[:meta["size"]]
+        state["id_map"] = {doc_id: row for row, doc_id in enumerate(state["doc_ids"])}
+        if os.path.isfile(self.file("ivf.npz")):
+            ivf = np.load(self.file("ivf.npz"))
+            state["centroids"], state["assignments"] = ivf["centroids"], ivf["assignments"][:meta["size"]]
+        return state
+
+    def load(self):
+        # build the new state first and swap it in at once, so that there is no
+        # point at which the index is half loaded
+        self.__dict__.update(self.read_state())
+
+    def write_meta(self):
+        tmp = self.file("meta.json.tmp")
+        with open(tmp, "w") as f:
+            json.dump({"dim": self.dim, "size": self.size, "dtype": self.dtype, "type_codes": self.type_codes}, f)
+        os.replace(tmp, self.file("meta.json"))
+
+    def allocate(self, capacity):
+        """
+        Create (or grow) the memory-mapped matrices to hold `capacity` rows
+        """
+        os.makedirs(self.path, exist_ok=True)
+        for name, shape, dtype, fill in self.arrays():
+            old, tmp = getattr(self, name), self.file(name + ".tmp")
+            new = np.lib.format.open_memmap(tmp, mode="w+", dtype=dtype, shape=(capacity, *shape))
+            new[:] = fill
+            if old is not None:
+                new[:self.size] = old[:self.size]
+            new.flush()
+            del new
+            os.replace(tmp, self.file(name + ".npy"))
+            setattr(self, name, np.load(self.file(name + ".npy"), mmap_mode="r+"))
+
+    # quantization
+    def quantize(self, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        vectors = vectors / norms
+        if self.dtype == "int8":
+            scales = np.abs(vectors).max(axis=1) / 127
+            scales[scales == 0] = 1
+            return np.round(vectors / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+        return vectors.astype(np.float16), None
+
+    def dequantize(self, rows):
+        vectors = np.asarray(self.vectors[rows], dtype=np.float32)
+        if self.dtype == "int8":
+            vectors *= self.scales[rows][..., None]
+        return vectors
+
+    def score(self, query, rows):
+        scores = np.asarray(self.vectors[rows], dtype=np.float32) @ query
+        if self.dtype == "int8":
+            scores *= self.scales[rows]
+        return scores
+
+    # write
+    def encode_payloads(self, payloads):
+        types = np.full(len(payloads), MISSING_TYPE, dtype=np.uint8)
+        years = np.full((len(payloads), 2), MISSING_YEAR, dtype=np.int32)
+        for row, payload in enumerate(payloads):
+            type_of_reference = payload.get("type_of_reference")
+            if type_of_reference:
+                if type_of_reference not in self.type_codes:
+                    self.type_codes.append(type_of_reference)
+                types[row] = self.type_codes.index(type_of_reference)
+            for col, field in enumerate(("year", "end_year")):
+                if field in payload:
+                    years[row, col] = payload[field]
+        return types, years
+
+    def _insert(self, vectors, doc_ids, payloads=None):
+        """
+        Upsert by doc_id (as QDrant does with point ids): rows of known documents are
+        overwritten in place and only new documents are appended
+        """
+        vectors, scales = self.quantize(vectors)
+        types, years = self.encode_payloads(payloads or [{} for _ in doc_ids])
+        if self.dim is None:
+            self.dim = vectors.shape[1]
+        rows, new_ids = [], {}
+        for doc_id in doc_ids:
+            row = self.id_map.get(doc_id)
+            if row is None: # repeated doc_ids within a batch share a row (the last one wins)
+                row = new_ids.setdefault(doc_id, self.size + len(new_ids))
+            rows.append(row)
+        rows, end = np.asarray(rows, dtype=np.int64), self.size + len(new_ids)
+        if any(getattr(self, name) is None for name, *_ in self.arrays()) or end > len(self.vectors):
+            self.allocate(max(1024, 2 * end))
+        self.vectors[rows], self.types[rows], self.years[rows] = vectors, types, years
+        if scales is not None:
+            self.scales[rows] = scales
+        for name, *_ in self.arrays():
+            getattr(self, name).flush()
+        with open(self.file("doc_ids.txt"), "a") as f:
+            f.write("".join(doc_id + "\n" for doc_id in new_ids))
+        self.id_map.update(new_ids)
+        self.doc_ids.extend(new_ids)
+        if self.centroids is not None:
+            assignments = np.zeros(end, dtype=np.int32)
+            assignments[:self.size] = self.assignments[:self.size]
+            assignments[rows] = self.assign(self.dequantize(rows))
+            self.assignments = assignments
+            self.save_ivf()
+        self.size = end
+        self.write_meta()
+
+    async def insert(self, vectors, doc_ids, payloads=None, batch_size=500, collection_name=None, **kwargs):
+        """
+        Vector ingestion logic
+        """
+        assert len(vectors) == len(doc_ids)
+        if collection_name is not None:
+            return await self.get_staging(collection_name).insert(
+                vectors, doc_ids, payloads=payloads, batch_size=batch_size)
+        async with self.lock:
+            for i in range(0, len(doc_ids), batch_size):
+                await asyncio.to_thread(self._insert, vectors[i:i+batch_size], doc_ids[i:i+batch_size],
+                                        payloads[i:i+batch_size] if payloads else None)
+        if self.staging is not None:
+            await self.staging.insert(vectors, doc_ids, payloads=payloads, batch_size=batch_size)
+        return True
+
+    async def insert_stream(self, batches, collection_name=None, logger=logger, **kwargs):
+        """
+        Vector ingestion from an async iterator of (doc_ids, vectors[, payloads]) batches
+        """
+        total, start = 0, time.time()
+        async for doc_ids, vectors, *payloads in batches:
+            await self.insert(vectors, doc_ids, payloads=payloads[0] if payloads else None,
+                              collection_name=collection_name)
+            total += len(doc_ids)
+        elapsed = time.time() - start
+        await utils.maybe_await(logger.info("Indexed {} vectors in {:.2f} secs ({:.1f} vectors/sec)".format(
+            total, elapsed, total / max(elapsed, 1e-6))))
+        return total
+
+    # ivf
+    def assign(self, vectors):
+        return np.argmax(vectors @ self.centroids.T, axis=1).astype(np.int32)
+
+    def save_ivf(self):
+        np.savez(self.file("ivf.tmp.npz"), centroids=self.centroids, assignments=self.assignments)
+        os.replace(self.file("ivf.tmp.npz"), self.file("ivf.npz"))
+
+    def _train_ivf(self, n_lists, iterations, sample_size, seed):
+        rng = np.random.default_rng(seed)
+        sample = self.dequantize(np.sort(rng.choice(self.size, min(sample_size, self.size), replace=False)))
+        n_lists = min(n_lists, len(sample))
+        centroids = sample[rng.choice(len(sample), n_lists, replace=False)]
+        for _ in range(iterations):
+            assignments = np.argmax(sample @ centroids.T, axis=1)
+            for cell in range(n_lists):
+                members = sample[assignments == cell]
+                if len(members):
+                    centroid = members.sum(axis=0)
+                    centroids[cell] = centroid / (np.linalg.norm(centroid) or 1)
+        self.centroids = centroids
+        self.assignments = np.concatenate([
+            self.assign(self.dequantize(slice(start, min(start + self.block_size, self.size))))
+            for start in range(0, self.size, self.block_size)] or [np.zeros(0, dtype=np.int32)])
+        self.save_ivf()
+
+    async def train_ivf(self, n_lists=None, iterations=10, sample_size=100_000, seed=1001):
+        """
+        Train a (spherical) k-means coarse quantizer for approximate search
+        """
+        n_lists = n_lists or max(1, int(np.sqrt(self.size)))
+        async with self.lock:
+            await asyncio.to_thread(self._train_ivf, n_lists, iterations, sample_size, seed)
+
+    # read
+    def facet_mask(self, type_of_reference=None, year=None):
+        """
+        Boolean mask over rows matching the facets (see `pagination.build_query`)
+        """
+        if not type_of_reference and not year:
+            return
+        mask = np.ones(self.size, dtype=bool)
+        if type_of_reference:
+            if type_of_reference not in self.type_codes:
+                return np.zeros(self.size, dtype=bool)
+            mask &= self.types[:self.size] == self.type_codes.index(type_of_reference)
+        if year:
+            years, end_years = self.years[:self.size, 0], self.years[:self.size, 1]
+            if "-" in year: # year range
+                start, end = map(int, year.split('-'))
+                mask &= ((years >= start) & (years < end)) | ((end_years >= start) & (end_years < end))
+            else:
+                mask &= (years >= int(year)) & (end_years <= int(year) + 1) & (end_years != MISSING_YEAR)
+        return mask
+
+    def _search(self, row, limit, offset=0, threshold=None, **facets):
+        query = self.dequantize(row)
+        candidates = None
+        if self.centroids is not None and self.nprobe > 0:
+            cells = np.argsort(-(self.centroids @ query))[:self.nprobe]
+            candidates = np.nonzero(np.isin(self.assignments, cells))[0]
+        mask = self.facet_mask(**facets)
+        if mask is not None:
+            candidates = np.nonzero(mask)[0] if candidates is None else candidates[mask[candidates]]
+        if candidates is None:
+            candidates = np.arange(self.size)
+            blocks = [slice(start, min(start + self.block_size, self.size))
+                      for start in range(0, self.size, self.block_size)]
+        else:
+            blocks = [candidates[start:start + self.block_size]
+                      for start in range(0, len(candidates), self.block_size)]
+        scores = np.concatenate([self.score(query, rows) for rows in blocks] or [np.zeros(0, dtype=np.float32)])
+        keep = (candidates != row) & (scores >= threshold if threshold else True)
+        candidates, scores = candidates[keep], scores[keep]
+        n = min(offset + limit, len(scores))
+        if n <= offset:
+            return []
+        top = np.argpartition(-scores, n - 1)[:n]
+        top = top[np.argsort(-scores[top], kind="stable")][offset:]
+        return [{"doc_id": self.doc_ids[candidates[idx]], "score": float(scores[idx])} for idx in top]
+
+    def get_row(self, doc_id):
+        if doc_id not in self.id_map:
+            raise MissingVectorException("Unknown document: {}".format(doc_id))
+        return self.id_map[doc_id]
+
+    async def search(self, doc_id, limit=10, offset=0, threshold=None, **facets):
+        """
+        Find top-k (`limit`) nearest neighbors to the given `doc_id`, optionally restricted
+        to the given facets (type_of_reference, year) and to a minimum similarity
+        """
+        # search on a snapshot of the index attributes, taken in the event loop, so that
+        # concurrent insertions or version switches don't change the maps mid-search
+        # (memory maps of replaced files remain valid)
+        snapshot = copy.copy(self)
+        return await asyncio.to_thread(
+            snapshot._search, snapshot.get_row(doc_id), limit, offset=offset, threshold=threshold, **facets)
+
+    async def search_page(self, doc_id, page, size, limit, threshold=None, **facets):
+        """
+        Retrieve a page of the top-k (`limit`) nearest neighbors in score order, together with
+        the total number of neighbors matching the facets and threshold (at most `limit`)
+        """
+        hits = await self.search(doc_id, limit=limit, threshold=threshold, **facets)
+        return hits[(page - 1) * size: page * size], len(hits)
+
+    async def find_vector_by_id(self, doc_id):
+        if doc_id not in self.id_map:
+            return []
+        return [{"doc_id": doc_id, "vector": self.dequantize(self.id_map[doc_id])}]
+
+    async def find_vectors_by_ids(self, doc_ids):
+        doc_ids = [doc_id for doc_id in doc_ids if doc_id in self.id_map]
+        if not doc_ids:
+            return [], np.zeros((0, self.dim or 0), dtype=np.float32)
+        return doc_ids, self.dequantize([self.id_map[doc_id] for doc_id in doc_ids])
+
+    async def count(self, collection_name=None, **kwargs):
+        if collection_name is not None:
+            return await self.get_staging(collection_name).count()
+        return self.size
+
+    async def iter_vectors(self, batch_size=1_000):
+        """
+        Iterate over all stored vectors, yielding (doc_ids, vectors) batches
+        """
+        for start in range(0, self.size, batch_size):
+            end = min(start + batch_size, self.size)
+            yield self.doc_ids[start:end], self.dequantize(slice(start, end))
+
+    async def get_vectors(self):
+        """
+        Utility function to retrieve vectors from the database
+        """
+        return [{"id": row, "payload": {"doc_id": doc_id}} for row, doc_id in enumerate(self.doc_ids)]
+
+    # versioning
+    def get_staging(self, version):
+        if self.staging is None or self.staging.path != version:
+            raise ValueError("Unknown index version: {}".format(version))
+        return self.staging
+
+    async def create_version(self):
+        """
+        Start building a new version of the index in a sibling directory. Until it is
+        switched or dropped, all insertions are also written to the new version.
+        """
+        version = "{}.{}".format(
+            os.path.normpath(self.path), datetime.now(timezone.utc).strftime("%Y%m%d%H%M%S%f"))
+        self.staging = MemmapVectorClient(
+            path=version, dtype=self.dtype, nprobe=self.nprobe, block_size=self.block_size)
+        return version
+
+    async def switch_version(self, version):
+        """
+        Replace the index with the given version. Queries that are running keep using the
+        memory maps of the previous version, and new queries use the new one once loaded.
+        """
+        staging = self.get_staging(version)
+        async with self.lock:
+            await staging.close()
+            old = version + ".old"
+            if os.path.isdir(self.path):
+                os.replace(self.path, old)
+            if os.path.isdir(version):
+                os.replace(version, self.path)
+            self.staging = None
+            self.load()
+            shutil.rmtree(old, ignore_errors=True)
+
+    async def drop_version(self, version):
+        """
+        Discard a version that was being built
+        """
+        self.get_staging(version)
+        shutil.rmtree(version, ignore_errors=True)
+        self.staging = None
+
+    async def _clear_up(self):
+        async with self.lock:
+            for name in ("meta.json", "vectors.npy", "scales.npy", "types.npy", "years.npy", "doc_ids.txt", "ivf.npz"):
+                if os.path.isfile(self.file(name)):
+                    os.remove(self.file(name))
+            self.load()
+
+    async def close(self):
+        if self.vectors is not None:
+            self.vectors.flush()
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Maintenance of the memory-mapped vector index")
+    parser.add_argument('--train-ivf', action='store_true', help="Train the IVF coarse quantizer")
+    parser.add_argument('--n-lists', type=int, help="Number of IVF cells (defaults to sqrt(#vectors))")
+    args = parser.parse_args()
+
+    async def main():
+        client = MemmapVectorClient()
+        if args.train_ivf:
+            await client.train_ivf(n_lists=args.n_lists)
+        print("Index at {}: {} vectors".format(client.path, await client.count()))
+
+    asyncio.run(main())
@@ -2,6 +2,7 @@
 import uuid
 from datetime import datetime
 from string import Formatter
+from functools import lru_cache
 
 from typing import List, Optional, Dict, Generic, TypeVar, Literal, Union, Any
 from typing_extensions import Self
@@ -25,6 +26,28 @@ def format_str_from_ris(repr_str):
     return repr_str.replace("[", "{").replace("]", "}")
 
 
+class CompiledScreen:
+    """
+    Screen representation compiled into a format string and the document fields it needs
+    """
+    def __init__(self, repr_str) -> None:
+        self.repr_str = repr_str
+        self.format_str = format_str_from_ris(repr_str)
+        self.fields = [fname for _, fname, _, _ in Formatter().parse(self.format_str) if fname]
+
+    def missing_fields(self, doc):
+        return [fname for fname in self.fields if not doc.get(fname)]
+
+    def render(self, doc):
+        # only the fields in the template are materialized
+        return self.format_str.format_map({fname: utils.maybe_list(doc[fname]) for fname in self.fields})
+
+
+@lru_cache(maxsize=None)
+def compile_screen(repr_str) -> CompiledScreen:
+    return CompiledScreen(repr_str)
+
+
 class DocScreen:
     """
     This class handles required fields on the basis of the screen representation
@@ -73,21 +96,20 @@ class DocScreen:
         else:
             raise ValueError(f"Unknown publication type: {doc['type_of_reference']}")
 
+    @staticmethod
+    def get_screen(doc) -> CompiledScreen:
+        """
+        Compiled screen representation of a document (templates are compiled once)
+        """
+        return compile_screen(DocScreen.get_repr_str(doc))
+
     @staticmethod
     def find_missing_fields(doc):
-        repr_str = format_str_from_ris(DocScreen.get_repr_str(doc))
-        missing = []
-        for _, fname, _, _ in Formatter().parse(format_str_from_ris(repr_str)):
-            if not fname: continue
-            if not doc.get(fname):
-                missing.append(fname)
-        return missing
+        return DocScreen.get_screen(doc).missing_fields(doc)
 
     @staticmethod
     def render_doc(doc):
-        repr_str = format_str_from_ris(DocScreen.get_repr_str(doc))
-        kwargs = {k: utils.maybe_list(v) for k, v in doc.items()}
-        return repr_str.format_map(kwargs)
+        return DocScreen.get_screen(doc).render(doc)
 
 
 TypeOfReference = Literal["JOUR", "BOOK", "CHAP", "EJOUR", "WEB", "JFULL", "ADVS"]
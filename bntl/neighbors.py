@@ -0,0 +1,237 @@
+import logging
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Optional
+
+import numpy as np
+from pymongo import ReplaceOne
+
+from bntl.settings import settings
+from bntl import utils
+
+
+logger = logging.getLogger(__name__)
+
+
+def normalize(vectors) -> np.ndarray:
+    """
+    L2-normalize rows so that dot products become cosine similarities
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+def merge_topk(scores, ids, new_scores, new_ids, k):
+    """
+    Row-wise merge of two candidate sets, keeping the top-k sorted by descending score
+    """
+    scores = np.concatenate([scores, new_scores], axis=1)
+    ids = np.concatenate([ids, new_ids], axis=1)
+    if scores.shape[1] > k:
+        idx = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        scores, ids = np.take_along_axis(scores, idx, 1), np.take_along_axis(ids, idx, 1)
+    order = np.argsort(-scores, axis=1, kind="stable")
+    return np.take_along_axis(scores, order, 1), np.take_along_axis(ids, order, 1)
+
+
+def topk_block(queries, corpus, k, query_idxs=None, corpus_block=4096):
+    """
+    Exact top-k neighbors of a block of (normalized) queries against a (normalized) corpus.
+    The corpus is traversed in blocks, so that at most (len(queries), corpus_block) scores
+    are held in memory at any time. `query_idxs` holds the row of each query inside the
+    corpus (or -1), and is used to skip self-similarity.
+    """
+    n = len(queries)
+    scores = np.full((n, 0), -np.inf, dtype=np.float32)
+    ids = np.full((n, 0), -1, dtype=np.int64)
+    for start in range(0, len(corpus), corpus_block):
+        block = np.asarray(corpus[start:start + corpus_block], dtype=np.float32)
+        sims = queries @ block.T
+        if query_idxs is not None:
+            rows = np.nonzero((query_idxs >= start) & (query_idxs < start + len(block)))[0]
+            sims[rows, query_idxs[rows] - start] = -np.inf
+        block_ids = np.broadcast_to(np.arange(start, start + len(block)), sims.shape)
+        if sims.shape[1] > k:
+            idx = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+            sims, block_ids = np.take_along_axis(sims, idx, 1), np.take_along_axis(block_ids, idx, 1)
+        scores, ids = merge_topk(scores, ids, sims, block_ids, k)
+    return scores, ids
+
+
+def build_table(corpus, k, query_block=1024, corpus_block=4096, workers=None):
+    """
+    Compute the exact top-k cosine neighbors for every row in the corpus. Query blocks are
+    processed in parallel threads (NumPy releases the GIL during matrix products and
+    partitioning), and memory stays bounded by `workers * query_block * corpus_block`.
+    Returns (scores, ids) arrays of shape (len(corpus), k).
+    """
+    k = min(k, len(corpus) - 1)
+    scores = np.zeros((len(corpus), k), dtype=np.float32)
+    ids = np.zeros((len(corpus), k), dtype=np.int64)
+
+    def run(start):
+        queries = np.asarray(corpus[start:start + query_block], dtype=np.float32)
+        query_idxs = np.arange(start, start + len(queries))
+        b_scores, b_ids = topk_block(queries, corpus, k, query_idxs=query_idxs, corpus_block=corpus_block)
+        scores[start:start + len(queries)], ids[start:start + len(queries)] = b_scores, b_ids
+        return start
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for start in executor.map(run, range(0, len(corpus), query_block)):
+            logger.info("Done neighbors for rows {}-{}".format(start, start + query_block))
+
+    return scores, ids
+
+
+def to_entries(doc_ids, scores, ids, corpus_doc_ids, k):
+    """
+    Transform a neighbor table into the compact format stored in MongoDB
+    """
+    entries = []
+    for doc_id, row_scores, row_ids in zip(doc_ids, scores, ids):
+        keep = np.isfinite(row_scores)
+        entries.append({
+            "doc_id": doc_id,
+            "neighbors": [corpus_doc_ids[idx] for idx in row_ids[keep]],
+            "scores": [round(float(score), 5) for score in row_scores[keep]],
+            # rows with less than k neighbors accept any new candidate
+            "min_score": float(row_scores[keep][-1]) if keep.sum() >= k else -1.0})
+    return entries
+
+
+async def load_corpus(vector_client, path: Optional[str]=None, batch_size=1_000, logger=logger):
+    """
+    Load all (normalized) vectors from the vector database. If `path` is given, the matrix
+    is written to a memory-mapped file instead of being held in memory.
+    """
+    total = await vector_client.count(exact=True)
+    corpus, doc_ids = None, []
+    async for batch_ids, vectors in vector_client.iter_vectors(batch_size=batch_size):
+        if corpus is None:
+            shape = (total, vectors.shape[1])
+            if path:
+                corpus = np.lib.format.open_memmap(path, mode="w+", dtype=np.float32, shape=shape)
+            else:
+                corpus = np.zeros(shape, dtype=np.float32)
+        if len(doc_ids) + len(batch_ids) > total:
+            # points added while scrolling are left out of this build
+            await utils.maybe_await(logger.warning(
+                "Collection grew beyond {} vectors while loading, ignoring the rest".format(total)))
+            batch_ids, vectors = batch_ids[:total - len(doc_ids)], vectors[:total - len(doc_ids)]
+        corpus[len(doc_ids):len(doc_ids) + len(batch_ids)] = normalize(vectors)
+        doc_ids.extend(batch_ids)
+        if len(doc_ids) >= total:
+            break
+    if corpus is None:
+        return None, []
+    # points may also have been deleted while scrolling
+    return corpus[:len(doc_ids)], doc_ids
+
+
+async def write_entries(neighbors_coll, entries, batch_size=1_000):
+    for start in range(0, len(entries), batch_size):
+        await neighbors_coll.bulk_write(
+            [ReplaceOne({"doc_id": entry["doc_id"]}, entry, upsert=True)
+             for entry in entries[start:start + batch_size]],
+            ordered=False)
+
+
+async def build_neighbors(db_client, vector_client, k=None, path=None, workers=None, logger=logger):
+    """
+    Offline computation of the full neighbor table
+    """
+    k = k or settings.NEIGHBORS_K
+    await utils.maybe_await(logger.info("Loading vectors..."))
+    corpus, doc_ids = await load_corpus(vector_client, path=path, logger=logger)
+    if len(doc_ids) < 2:
+        await utils.maybe_await(logger.info("Not enough vectors to compute neighbors"))
+        return 0
+    await utils.maybe_await(logger.info("Computing top-{} neighbors for {} vectors...".format(k, len(doc_ids))))
+    scores, ids = await asyncio.to_thread(
+        build_table, corpus, k, corpus_block=settings.NEIGHBORS_BLOCK_SIZE, workers=workers)
+    await utils.maybe_await(logger.info("Storing neighbor table..."))
+    await db_client.neighbors_coll.drop()
+    await db_client.neighbors_coll.create_index("doc_id", unique=True)
+    await write_entries(db_client.neighbors_coll, to_entries(doc_ids, scores, ids, doc_ids, k))
+    return len(doc_ids)
+
+
+async def update_neighbors(db_client, vector_client, new_doc_ids: List[str], k=None, logger=logger):
+    """
+    Update the neighbor table after ingesting `new_doc_ids`. New rows are computed against
+    the full corpus, and existing rows are only rewritten if one of the new documents
+    enters their top-k.
+    """
+    k = k or settings.NEIGHBORS_K
+    new_doc_ids, new_vectors = await vector_client.find_vectors_by_ids(new_doc_ids)
+    if not new_doc_ids:
+        return 0
+    new_vectors = normalize(new_vectors)
+    new_idxs = {doc_id: idx for idx, doc_id in enumerate(new_doc_ids)}
+    min_scores: Dict[str, float] = {
+        item["doc_id"]: item["min_score"] async for item in db_client.neighbors_coll.find(
+            {}, {"_id": 0, "doc_id": 1, "min_score": 1})}
+
+    scores = np.full((len(new_doc_ids), 0), -np.inf, dtype=np.float32)
+    ids = np.full((len(new_doc_ids), 0), -1, dtype=np.int64)
+    corpus_doc_ids, candidates = [], {}
+    async for batch_ids, vectors in vector_client.iter_vectors():
+        offset = len(corpus_doc_ids)
+        corpus_doc_ids.extend(batch_ids)
+        block = normalize(vectors)
+        # new rows
+        query_idxs = np.full(len(new_doc_ids), -1)
+        for i, doc_id in enumerate(batch_ids):
+            if doc_id in new_idxs:
+                query_idxs[new_idxs[doc_id]] = offset + i
+        b_scores, b_ids = topk_block(new_vectors, block, k, query_idxs=query_idxs - offset, corpus_block=len(block))
+        scores, ids = merge_topk(scores, ids, b_scores, b_ids + offset, k)
+        # existing rows affected by the new documents
+        sims = block @ new_vectors.T
+        for i, doc_id in enumerate(batch_ids):
+            if doc_id in new_idxs or doc_id not in min_scores:
+                continue
+            hits = np.nonzero(sims[i] > min_scores[doc_id])[0]
+            if len(hits):
+                candidates[doc_id] = [(new_doc_ids[j], float(sims[i, j])) for j in hits]
+
+    entries = to_entries(new_doc_ids, scores, ids, corpus_doc_ids, k)
+    async for item in db_client.neighbors_coll.find({"doc_id": {"$in": list(candidates)}}, {"_id": 0}):
+        merged = dict(zip(item["neighbors"], item["scores"]))
+        merged.update((doc_id, round(score, 5)) for doc_id, score in candidates[item["doc_id"]])
+        merged = sorted(merged.items(), key=lambda pair: pair[1], reverse=True)[:k]
+        entries.append({"doc_id": item["doc_id"],
+                        "neighbors": [doc_id for doc_id, _ in merged],
+                        "scores": [score for _, score in merged],
+                        "min_score": merged[-1][1] if len(merged) >= k else -1.0})
+    await utils.maybe_await(logger.info("Updating {} neighbor rows ({} new)".format(len(entries), len(new_doc_ids))))
+    await write_entries(db_client.neighbors_coll, entries)
+    return len(entries)
+
+
+if __name__ == '__main__':
+    import argparse
+    from bntl.db import DBClient
+    from bntl.vector import create_vector_client
+    from bntl.settings import setup_logger
+
+    parser = argparse.ArgumentParser(description="Build the precomputed neighbor table")
+    parser.add_argument('--k', type=int, default=settings.NEIGHBORS_K)
+    parser.add_argument('--workers', type=int, default=None, help="Number of parallel query blocks")
+    parser.add_argument('--memmap', help="Path to a .npy file to hold the vectors instead of memory")
+    args = parser.parse_args()
+
+    async def main():
+        setup_logger()
+        db_client, vector_client = await DBClient.create(), create_vector_client()
+        try:
+            done = await build_neighbors(
+                db_client, vector_client, k=args.k, path=args.memmap, workers=args.workers)
+            logger.info("Computed neighbors for {} documents".format(done))
+        finally:
+            db_client.close()
+            await vector_client.close()
+
+    asyncio.run(main())
@@ -152,6 +152,37 @@ async def paginate(coll,
         **kwargs)
 
 
+async def paginate_hits(coll,
+                        hits: List[Dict],
+                        n_hits: int,
+                        page_params: PageParams,
+                        ResponseModel: BaseModel) -> PagedResponseModel[T]:
+    """
+    Pagination over an already paginated list of vector search hits (`doc_id`, `score`),
+    where `n_hits` is the total number of hits. Documents are returned in hit order.
+    """
+    page, size = page_params.page, page_params.size
+    results = await coll.find({"_id": {"$in": [ObjectId(hit["doc_id"]) for hit in hits]}}).to_list(length=None)
+    results = {str(item.pop("_id")): item for item in results}
+    items = []
+    for hit in hits:
+        if hit["doc_id"] in results:
+            items.append(ResponseModel.model_validate(
+                {**results[hit["doc_id"]], "doc_id": hit["doc_id"], "score": hit["score"]}))
+
+    total_pages = math.ceil(n_hits / size)
+    return PagedResponseModel(
+        n_hits=n_hits,
+        from_page=max(1, page - 4),
+        to_page=min(total_pages, page + 4),
+        total_pages=total_pages,
+        sort_author=page_params.sort_author,
+        sort_year=page_params.sort_year,
+        page=page,
+        size=size,
+        items=items)
+
+
 async def paginate_within(coll, 
                           original_query: QueryParams,
                           within_query: str, 
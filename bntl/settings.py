@@ -1,10 +1,10 @@
 
-from typing import Type, Tuple
+from typing import Type, Tuple, Literal, Dict, Optional
 import logging.config
 
 from pydantic_settings import BaseSettings, SettingsConfigDict
 from pydantic_settings import PydanticBaseSettingsSource, TomlConfigSettingsSource
-from pydantic import Field
+from pydantic import BaseModel, Field
 
 import toml
 
@@ -15,6 +15,29 @@ def setup_logger(path='settings_logger.toml'):
         logging.config.dictConfig(config)
 
 
+class QdrantProfile(BaseModel):
+    """
+    QDrant collection tuning parameters (applied upon collection creation, besides the
+    search-time parameters). See `benchmarks/qdrant_profiles.py` to compare them.
+    """
+    hnsw_m: int = Field(help="Number of edges per node in the HNSW graph", default=16)
+    hnsw_ef_construct: int = Field(help="Size of the candidate list when building the HNSW graph", default=100)
+    hnsw_on_disk: bool = Field(help="Store the HNSW graph on disk", default=False)
+    search_ef: Optional[int] = Field(help="Size of the candidate list at search time (QDrant default if unset)", default=None)
+    on_disk: bool = Field(help="Store the original vectors on disk", default=False)
+    quantization: Literal["none", "scalar", "binary"] = Field(help="Vector quantization", default="none")
+    quantization_always_ram: bool = Field(help="Keep the quantized vectors in RAM", default=True)
+    rescore: bool = Field(help="Rescore quantized results with the original vectors", default=True)
+    oversampling: Optional[float] = Field(help="Oversampling factor for quantized search", default=None)
+
+
+DEFAULT_QDRANT_PROFILES = {
+    "default": QdrantProfile(),
+    "accurate": QdrantProfile(hnsw_m=32, hnsw_ef_construct=256, search_ef=256),
+    "compact": QdrantProfile(on_disk=True, quantization="scalar", oversampling=1.5),
+    "binary": QdrantProfile(on_disk=True, quantization="binary", oversampling=3.0)}
+
+
 class Settings(BaseSettings):
     PORT: int = Field(help="Server port")
 
@@ -29,14 +52,36 @@ class Settings(BaseSettings):
     UPLOAD_SECRET: str = Field(help="Secret to run the upload logic")
 
     WITHIN_MAX_RESULTS: int = Field(help="Restrict results of original query to this number when doing recursive query", default=300_000)
-    MAX_EXPORT_RESULTS: int = Field(help="Maximum number of documents to be exported", default=100)
-
+    MAX_EXPORT_RESULTS: int = Field(help="Maximum number of documents to be exported (0 for no limit)", default=0)
+    EXPORT_BATCH_SIZE: int = Field(help="Number of documents rendered at once when exporting", default=500)
+    DUMP_TOKEN: Optional[str] = Field(
+        help="Bearer token for the bulk dump endpoint (defaults to the UPLOAD_SECRET)", default=None)
+    DUMP_BATCH_SIZE: int = Field(help="Number of documents fetched at once when dumping records", default=1_000)
+
+    VECTOR_BACKEND: Literal["qdrant", "memmap"] = Field(
+        help="Vector database backend: QDrant server or in-process memory-mapped index", default="qdrant")
     QDRANT_PORT: int = Field(help="Port used by QDrant (usually 6333)")
     QDRANT_COLL: str = Field(default="bntl")
+    QDRANT_PROFILES: Dict[str, QdrantProfile] = Field(
+        help="Named QDrant collection tuning profiles", default=DEFAULT_QDRANT_PROFILES)
+    QDRANT_PROFILE: str = Field(help="QDrant tuning profile used for new collections", default="default")
+    QDRANT_UPLOAD_BATCH_SIZE: int = Field(help="Number of points per QDrant upsert request", default=500)
+    QDRANT_UPLOAD_PARALLEL: int = Field(help="Number of QDrant upsert requests in flight during indexing", default=4)
+    VECTOR_INDEX_DIR: str = Field(help="Directory holding the memory-mapped vector index", default="./vector_index")
+    VECTOR_INDEX_DTYPE: Literal["float16", "int8"] = Field(
+        help="Storage type of the memory-mapped vectors", default="float16")
+    VECTOR_INDEX_NPROBE: int = Field(
+        help="Number of IVF cells to probe in the memory-mapped index (0 for exact search)", default=0)
+
+    NEIGHBORS_COLL: str = Field(help="MongoDB collection name for the precomputed neighbor table", default="neighbors")
+    NEIGHBORS_K: int = Field(help="Number of neighbors stored per document in the neighbor table", default=100)
+    NEIGHBORS_BLOCK_SIZE: int = Field(help="Corpus block size when computing the neighbor table", default=4096)
 
     UPLOAD_LOG_DIR: str = Field(default="./logs", help="Directory to store the upload log files")
     BABEL_TRANSLATIONS_DIR: str = Field(default="static/translations")
 
+    REVECTORIZE_BATCH_SIZE: int = Field(help="Number of documents per vectorizer sub-task when revectorizing", default=10_000)
+
     RETRY_DELAY: int = Field(default=3600 * 10)
     MAX_RETRIES: int = Field(default=5)
     BATCH_SIZE: int = Field(default=48)
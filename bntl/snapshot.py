@@ -0,0 +1,146 @@
+import os
+import json
+import time
+import asyncio
+import logging
+from datetime import datetime, timezone
+
+import numpy as np
+
+from bntl.settings import settings
+from bntl.vector import add_payloads
+from bntl import utils
+
+
+logger = logging.getLogger(__name__)
+
+
+# files inside a snapshot directory
+MANIFEST, VECTORS, DOC_IDS = "manifest.json", "vectors.npy", "doc_ids.npy"
+# doc ids are stored as fixed-width bytes (ObjectId hex strings take 24)
+DOC_ID_WIDTH = 32
+
+
+async def export_vectors(vector_client, path, dtype="float32", batch_size=1_000, logger=logger):
+    """
+    Export all vectors and doc ids from the vector database into a pair of memory-mappable
+    .npy files (plus a json manifest), paginating over the collection so that only one
+    batch is held in memory at any time
+    """
+    os.makedirs(path, exist_ok=True)
+    start, total = time.time(), await vector_client.count(exact=True)
+    vectors, doc_ids, n = None, None, 0
+    async for batch_ids, batch in vector_client.iter_vectors(batch_size=batch_size):
+        if vectors is None:
+            vectors = np.lib.format.open_memmap(
+                os.path.join(path, VECTORS), mode="w+", dtype=dtype, shape=(total, batch.shape[1]))
+            doc_ids = np.lib.format.open_memmap(
+                os.path.join(path, DOC_IDS), mode="w+", dtype="S{}".format(DOC_ID_WIDTH), shape=(total,))
+        if n + len(batch) > total:
+            # points added while exporting are left out of the snapshot
+            await utils.maybe_await(logger.warning(
+                "Collection grew beyond {} vectors while exporting, ignoring the rest".format(total)))
+            batch_ids, batch = batch_ids[:total - n], batch[:total - n]
+        vectors[n:n + len(batch)] = batch
+        batch_ids = [doc_id.encode() for doc_id in batch_ids]
+        if max(map(len, batch_ids), default=0) > DOC_ID_WIDTH:
+            raise ValueError("Doc ids longer than {} bytes can't be exported".format(DOC_ID_WIDTH))
+        doc_ids[n:n + len(batch)] = batch_ids
+        n += len(batch)
+        if n >= total:
+            break
+    if vectors is not None:
+        vectors.flush()
+        doc_ids.flush()
+
+    manifest = {"count": n,
+                "dim": None if vectors is None else vectors.shape[1],
+                "dtype": dtype,
+                "backend": settings.VECTOR_BACKEND,
+                "collection": settings.QDRANT_COLL,
+                "date_created": datetime.now(timezone.utc).isoformat()}
+    with open(os.path.join(path, MANIFEST), "w") as f:
+        json.dump(manifest, f, indent=2)
+    await utils.maybe_await(logger.info("Exported {} vectors to {} in {:.2f} secs".format(
+        n, path, time.time() - start)))
+    return manifest
+
+
+def load_snapshot(path):
+    """
+    Memory-map a snapshot, returning (manifest, vectors, doc_ids)
+    """
+    with open(os.path.join(path, MANIFEST)) as f:
+        manifest = json.load(f)
+    if not manifest["count"]:
+        return manifest, np.zeros((0, manifest["dim"] or 0)), np.zeros(0, dtype="S1")
+    vectors = np.load(os.path.join(path, VECTORS), mmap_mode="r")[:manifest["count"]]
+    doc_ids = np.load(os.path.join(path, DOC_IDS), mmap_mode="r")[:manifest["count"]]
+    return manifest, vectors, doc_ids
+
+
+async def iter_snapshot(path, batch_size=1_000):
+    """
+    Stream a snapshot in (doc_ids, vectors) batches
+    """
+    _, vectors, doc_ids = load_snapshot(path)
+    for start in range(0, len(doc_ids), batch_size):
+        yield ([doc_id.decode() for doc_id in doc_ids[start:start + batch_size]],
+               np.asarray(vectors[start:start + batch_size], dtype=np.float32))
+        await asyncio.sleep(0)
+
+
+async def import_vectors(vector_client, path, db_client=None, as_version=False, batch_size=1_000, logger=logger):
+    """
+    Bulk import a snapshot into the vector database. If `db_client` is given, the point
+    payloads are attached from the document database. With `as_version`, the snapshot
+    is imported into a new version of the index, which replaces the current one when done.
+    """
+    batches = iter_snapshot(path, batch_size=batch_size)
+    if db_client is not None:
+        batches = add_payloads(batches, db_client)
+    if not as_version:
+        return await vector_client.insert_stream(batches, logger=logger)
+
+    version = await vector_client.create_version()
+    try:
+        total = await vector_client.insert_stream(batches, collection_name=version, logger=logger)
+        await vector_client.switch_version(version)
+        return total
+    except Exception:
+        await vector_client.drop_version(version)
+        raise
+
+
+if __name__ == '__main__':
+    import argparse
+    from bntl.db import DBClient
+    from bntl.vector import create_vector_client
+    from bntl.settings import setup_logger
+
+    parser = argparse.ArgumentParser(description="Export and import vector database snapshots")
+    parser.add_argument('action', choices=['export', 'import'])
+    parser.add_argument('--path', required=True, help="Snapshot directory")
+    parser.add_argument('--dtype', default="float32", choices=["float16", "float32"], help="Export vector type")
+    parser.add_argument('--as-version', action='store_true',
+                        help="Import into a new index version and switch to it when done")
+    parser.add_argument('--no-payloads', action='store_true',
+                        help="Don't attach the document payloads from MongoDB when importing")
+    args = parser.parse_args()
+
+    async def main():
+        setup_logger()
+        vector_client, db_client = create_vector_client(), None
+        try:
+            if args.action == 'export':
+                await export_vectors(vector_client, args.path, dtype=args.dtype)
+            else:
+                if not args.no_payloads:
+                    db_client = await DBClient.create()
+                await import_vectors(vector_client, args.path, db_client=db_client, as_version=args.as_version)
+        finally:
+            await vector_client.close()
+            if db_client is not None:
+                db_client.close()
+
+    asyncio.run(main())
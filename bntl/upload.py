@@ -8,7 +8,9 @@ from typing import Dict
 import rispy
 
 from bntl import utils
+from bntl import neighbors
 from bntl.models import StatusModel
+from bntl.vector import add_payloads
 from vectorizer import client
 
 
@@ -32,6 +34,10 @@ class Status:
         return {key: getattr(cls, key) for key in vars(cls).keys() if not key.startswith('__')}
 
 
+# fields needed to build the text input to the vectorizer (see `convert_to_text`)
+TEXT_FIELDS = ("title", "secondary_title", "tertiary_title", "keywords")
+
+
 def get_doc_text(doc) -> Dict[str, str]:
     title = doc.get("title", "")
     if doc.get("secondary_title"):
@@ -114,25 +120,31 @@ class FileUploadManager:
                 await self.update_status(file_id, Status.EMPTYFILE)
                 return
             # vectorization
-            vectors = None
+            done = False
             try:
                 data = await self.db_client.find({"_id": {"$in": [ObjectId(id) for id in doc_ids]}})
                 await a_logger.info("Vectorizing {} documents...".format(len(doc_ids)))
                 await self.update_status(file_id, Status.VECTORIZING, progress=0)
                 texts = [convert_to_text(doc, ignore_keywords=True) for doc in data]
-                doc_ids = [str(doc["_id"]) for doc in data]
-                vectors = await client.vectorize(
-                    self.db_client.vectors_coll, file_id, texts, doc_ids, logger=a_logger)
+                doc_ids = [doc["doc_id"] for doc in data]
+                done = await client.vectorize(file_id, texts, doc_ids, logger=a_logger)
             except Exception as e:
                 await a_logger.info("Exception while vectorizing: [{}]".format(str(e)))
                 return
             finally:
-                if not vectors:
+                if not done:
                     await self.update_status(file_id, Status.VECTORIZINGERROR)
                     return
             try:
                 await a_logger.info("Indexing vectors...")
-                await self.vector_client.insert(vectors, doc_ids)
+                await self.vector_client.insert_stream(
+                    add_payloads(client.download_vectors(file_id), self.db_client),
+                    logger=a_logger)
+                await client.ack_task(file_id)
+                if await self.db_client.has_neighbors():
+                    await a_logger.info("Updating neighbor table...")
+                    await neighbors.update_neighbors(
+                        self.db_client, self.vector_client, doc_ids, logger=a_logger)
                 await self.update_status(file_id, Status.DONE)
             except Exception as e:
                 await self.update_status(file_id, Status.VECTORINDEXINGERROR, detail=str(e))
@@ -1,5 +1,6 @@
 
 import os
+import zlib
 from collections import defaultdict
 from datetime import datetime, timezone
 from typing import List, Union
@@ -64,6 +65,18 @@ class AsyncLogger:
         await self.log(message)
 
 
+async def gzip_stream(chunks):
+    """
+    Compress an async stream of bytes into a gzip stream
+    """
+    compressor = zlib.compressobj(wbits=31) # gzip container
+    async for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
 async def ris2xml(ris_data):
     proc = await asyncio.create_subprocess_exec(
         "ris2xml",
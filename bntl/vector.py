@@ -1,26 +1,139 @@
 
-from tqdm import tqdm
+import uuid
+import time
+import asyncio
+import logging
+from datetime import datetime, timezone
+
+from typing import Dict
 
 import numpy as np
 from qdrant_client import AsyncQdrantClient
-from qdrant_client.models import VectorParams, Distance, PointStruct
+from qdrant_client.models import VectorParams, Distance
 from qdrant_client import models
+from qdrant_client.http.exceptions import ResponseHandlingException
+
+from bntl.settings import settings, QdrantProfile
+from bntl import utils
+
 
-from bntl.settings import settings
+logger = logging.getLogger(__name__)
 
 
 class MissingVectorException(Exception):
     pass
 
 
+# errors raised when the vector database can't be reached
+CONNECTION_ERRORS = (ResponseHandlingException, ConnectionError)
+
+
+# filterable document fields stored in the point payloads, with their index type
+PAYLOAD_SCHEMA = {"type_of_reference": "keyword", "year": "integer", "end_year": "integer"}
+
+
+def get_payload(doc) -> Dict:
+    """
+    Extract the filterable fields of a document (see `PAYLOAD_SCHEMA`)
+    """
+    payload = {}
+    if doc.get("type_of_reference"):
+        payload["type_of_reference"] = doc["type_of_reference"]
+    for field in ("year", "end_year"):
+        try:
+            payload[field] = int(doc[field])
+        except (KeyError, TypeError, ValueError):
+            # unparsable years don't get retrieved by year queries
+            pass
+    return payload
+
+
+async def add_payloads(batches, db_client):
+    """
+    Attach the document payloads to a stream of (doc_ids, vectors) batches
+    """
+    projection = {field: 1 for field in PAYLOAD_SCHEMA}
+    async for doc_ids, vectors in batches:
+        docs = await db_client.find_by_ids(doc_ids, projection=projection)
+        yield doc_ids, vectors, [get_payload(doc or {}) for doc in docs]
+
+
+def build_filter(doc_id, type_of_reference=None, year=None):
+    """
+    Transform the query facets into a QDrant filter (see `pagination.build_query`),
+    excluding the query document itself
+    """
+    must = []
+    if type_of_reference:
+        must.append(models.FieldCondition(
+            key="type_of_reference", match=models.MatchValue(value=type_of_reference)))
+    if year:
+        if "-" in year: # year range
+            start, end = map(int, year.split('-'))
+            must.append(models.Filter(should=[
+                models.FieldCondition(key="year", range=models.Range(gte=start, lt=end)),
+                models.FieldCondition(key="end_year", range=models.Range(gte=start, lt=end))]))
+        else:
+            must.append(models.FieldCondition(key="year", range=models.Range(gte=int(year))))
+            must.append(models.FieldCondition(key="end_year", range=models.Range(lte=int(year) + 1)))
+    return models.Filter(
+        must=must,
+        must_not=[models.FieldCondition(key="doc_id", match=models.MatchValue(value=doc_id))])
+
+
+def collection_config(profile: QdrantProfile, dim: int) -> Dict:
+    """
+    Collection creation parameters for a tuning profile
+    """
+    quantization_config = None
+    if profile.quantization == "scalar":
+        quantization_config = models.ScalarQuantization(scalar=models.ScalarQuantizationConfig(
+            type=models.ScalarType.INT8, quantile=0.99, always_ram=profile.quantization_always_ram))
+    elif profile.quantization == "binary":
+        quantization_config = models.BinaryQuantization(binary=models.BinaryQuantizationConfig(
+            always_ram=profile.quantization_always_ram))
+    return {"vectors_config": VectorParams(size=dim, distance=Distance.COSINE, on_disk=profile.on_disk),
+            "hnsw_config": models.HnswConfigDiff(
+                m=profile.hnsw_m, ef_construct=profile.hnsw_ef_construct, on_disk=profile.hnsw_on_disk),
+            "quantization_config": quantization_config}
+
+
+def search_params(profile: QdrantProfile) -> models.SearchParams:
+    """
+    Search-time parameters for a tuning profile
+    """
+    quantization = None
+    if profile.quantization != "none":
+        quantization = models.QuantizationSearchParams(rescore=profile.rescore, oversampling=profile.oversampling)
+    return models.SearchParams(hnsw_ef=profile.search_ef, quantization=quantization)
+
+
+def point_id(doc_id: str) -> str:
+    """
+    Deterministic QDrant point id for a document id (usually a MongoDB ObjectId hex string)
+    """
+    try:
+        return str(uuid.UUID(doc_id.rjust(32, "0")))
+    except ValueError:
+        return str(uuid.uuid5(uuid.NAMESPACE_OID, doc_id))
+
+
 class VectorClient:
     """
     Client for a Vector database using QDrant
+
+    The live collection is accessed through an alias (`QDRANT_COLL`) pointing to a versioned
+    collection. This allows rebuilding the index into a new version in the background
+    (`create_version`), while the current one keeps serving queries, and switching over
+    atomically once it's done (`switch_version`).
     """
-    def __init__(self) -> None:
+    def __init__(self, profile=None) -> None:
         self.qdrant_client = AsyncQdrantClient(
             location="localhost", port=settings.QDRANT_PORT, timeout=100)
         self.collection_name = settings.QDRANT_COLL
+        self.profile = settings.QDRANT_PROFILES[profile or settings.QDRANT_PROFILE]
+        self.staging = None # version being built, it also receives all new insertions
+        self.ready = set() # collections known to exist
 
     async def find_vector_by_id(self, doc_id):
         hits, _ = await self.qdrant_client.scroll(self.collection_name, scroll_filter=models.Filter(
@@ -28,62 +141,249 @@ class VectorClient:
             with_vectors=True)
         return hits
 
-    async def search(self, doc_id, limit=10):
+    async def find_vectors_by_ids(self, doc_ids):
         """
-        Find top-k (`limit`) nearest neighbors to the given `doc_id`
+        Retrieve the vectors of the given `doc_ids`, returning (doc_ids, vectors) for the hits
         """
-        hits = await self.find_vector_by_id(doc_id)        
+        hits, _ = await self.qdrant_client.scroll(self.collection_name, scroll_filter=models.Filter(
+            must=[models.FieldCondition(key="doc_id", match=models.MatchAny(any=list(doc_ids)))]),
+            limit=len(doc_ids), with_vectors=True)
+        return [hit.payload["doc_id"] for hit in hits], np.array([hit.vector for hit in hits], dtype=np.float32)
+
+    async def get_query_vector(self, doc_id):
+        hits = await self.find_vector_by_id(doc_id)
         if len(hits) == 0:
             raise MissingVectorException("Unknown document: {}".format(doc_id))
+        return hits[0].vector
+
+    async def search(self, doc_id, limit=10, offset=0, threshold=None, **facets):
+        """
+        Find top-k (`limit`) nearest neighbors to the given `doc_id`, optionally restricted
+        to the given facets (type_of_reference, year) and to a minimum similarity
+        """
         hits = await self.qdrant_client.search(
-            collection_name=self.collection_name, 
-            query_vector=hits[0].vector,
-            limit=limit + 1)
-        _, *hits = hits # skip self similarity
+            collection_name=self.collection_name,
+            query_vector=await self.get_query_vector(doc_id),
+            query_filter=build_filter(doc_id, **facets),
+            limit=limit,
+            offset=offset,
+            score_threshold=threshold or None,
+            search_params=search_params(self.profile),
+            with_payload=["doc_id"])
         return [{"doc_id": hit.payload["doc_id"], "score": hit.score} for hit in hits]
 
-    async def count(self):
-        return (await self.qdrant_client.count(self.collection_name)).count
+    async def search_page(self, doc_id, page, size, limit, threshold=None, **facets):
+        """
+        Retrieve a page of the top-k (`limit`) nearest neighbors in score order, together with
+        the total number of neighbors matching the facets and threshold (at most `limit`)
+        """
+        hits = await self.search(doc_id, limit=limit, threshold=threshold, **facets)
+        return hits[(page - 1) * size: page * size], len(hits)
+
+    async def count(self, collection_name=None, exact=True):
+        return (await self.qdrant_client.count(collection_name or self.collection_name, exact=exact)).count
 
-    async def insert(self, vectors, doc_ids, batch_size=500):
+    # versioning
+    async def get_version(self):
         """
-        Vector ingestion logic
+        Name of the collection currently served under the alias (None if there is none)
         """
-        assert len(vectors) == len(doc_ids)
-        vectors = np.array(vectors)
-        if not await self.qdrant_client.collection_exists(self.collection_name):
-            await self.qdrant_client.create_collection(
-                collection_name=self.collection_name,
-                vectors_config=VectorParams(size=vectors.shape[1], distance=Distance.COSINE))
+        for alias in (await self.qdrant_client.get_aliases()).aliases:
+            if alias.alias_name == self.collection_name:
+                return alias.collection_name
+        collections = (await self.qdrant_client.get_collections()).collections
+        if self.collection_name in [collection.name for collection in collections]:
+            # legacy, non-aliased collection
+            return self.collection_name
+
+    def new_version_name(self):
+        return "{}-{}".format(self.collection_name, datetime.now(timezone.utc).strftime("%Y%m%d%H%M%S%f"))
+
+    async def create_collection(self, collection_name, dim):
+        await self.qdrant_client.create_collection(
+            collection_name=collection_name, **collection_config(self.profile, dim))
+        await self.qdrant_client.create_payload_index(
+            collection_name=collection_name,
+            field_name="doc_id",
+            field_schema="uuid")
+        for field_name, field_schema in PAYLOAD_SCHEMA.items():
             await self.qdrant_client.create_payload_index(
-                collection_name=self.collection_name,
-                field_name="doc_id",
-                field_schema="uuid")
-
-        cur = await self.count()
-        for i in tqdm(range(0, vectors.shape[0], batch_size)):
-            points = []
-            for v_id, vector in enumerate(vectors[i:i+batch_size]):
-                points.append(PointStruct(
-                    id=cur + i + v_id,
-                    vector=vector.tolist(),
-                    payload={"doc_id": doc_ids[i + v_id]}))
-            await self.qdrant_client.upsert(
-                collection_name=self.collection_name,
-                points=points)
+                collection_name=collection_name,
+                field_name=field_name,
+                field_schema=field_schema)
+        self.ready.add(collection_name)
+
+    async def ensure_collection(self, dim, collection_name=None):
+        """
+        Make sure the target collection exists. If the live collection is missing, a first
+        version is created and aliased.
+        """
+        collection_name = collection_name or self.collection_name
+        if collection_name in self.ready:
+            return
+        if collection_name == self.collection_name:
+            if await self.get_version() is None:
+                version = self.new_version_name()
+                await self.create_collection(version, dim)
+                await self.switch_version(version)
+        elif not await self.qdrant_client.collection_exists(collection_name):
+            await self.create_collection(collection_name, dim)
+        self.ready.add(collection_name)
+
+    async def create_version(self):
+        """
+        Start building a new version of the collection. Until it is switched or dropped,
+        all insertions into the live collection are also written to the new version.
+        """
+        version = self.new_version_name()
+        current = await self.get_version()
+        if current is not None:
+            info = await self.qdrant_client.get_collection(current)
+            await self.create_collection(version, info.config.params.vectors.size)
+        self.staging = version
+        return version
+
+    async def switch_version(self, version):
+        """
+        Atomically point the alias to the given version and drop the previous one
+        """
+        current = await self.get_version()
+        if current == self.collection_name:
+            # a legacy collection holds the alias name, it has to go before creating the alias
+            await self.qdrant_client.delete_collection(current)
+            current = None
+        operations = []
+        if current is not None:
+            operations.append(models.DeleteAliasOperation(
+                delete_alias=models.DeleteAlias(alias_name=self.collection_name)))
+        operations.append(models.CreateAliasOperation(
+            create_alias=models.CreateAlias(collection_name=version, alias_name=self.collection_name)))
+        await self.qdrant_client.update_collection_aliases(change_aliases_operations=operations)
+        if current is not None and current != version:
+            await self.qdrant_client.delete_collection(current)
+            self.ready.discard(current)
+        if self.staging == version:
+            self.staging = None
+
+    async def drop_version(self, version):
+        """
+        Discard a version that was being built
+        """
+        await self.qdrant_client.delete_collection(version)
+        self.ready.discard(version)
+        if self.staging == version:
+            self.staging = None
+
+    async def upsert(self, vectors, doc_ids, payloads=None, wait=True, collection_name=None):
+        """
+        Upsert a single batch of vectors in columnar format. Points are keyed by document id,
+        so that re-inserting a document overwrites its previous vector.
+        """
+        targets = [collection_name or self.collection_name]
+        if collection_name is None and self.staging is not None:
+            targets.append(self.staging)
+        payloads = payloads or [{} for _ in doc_ids]
+        points = models.Batch(
+            ids=[point_id(doc_id) for doc_id in doc_ids],
+            vectors=np.asarray(vectors, dtype=np.float32).tolist(),
+            payloads=[{"doc_id": doc_id, **payload} for doc_id, payload in zip(doc_ids, payloads)])
+        for target in targets:
+            await self.qdrant_client.upsert(collection_name=target, points=points, wait=wait)
 
+    async def insert(self, vectors, doc_ids, payloads=None, batch_size=None, parallel=None,
+                     collection_name=None, logger=logger):
+        """
+        Vector ingestion logic
+        """
+        assert len(vectors) == len(doc_ids)
+        async def batches():
+            yield doc_ids, np.asarray(vectors), payloads
+        await self.insert_stream(batches(), batch_size=batch_size, parallel=parallel,
+                                 collection_name=collection_name, logger=logger)
         return True
+
+    async def insert_stream(self, batches, batch_size=None, parallel=None, collection_name=None, logger=logger):
+        """
+        Vector ingestion from an async iterator of (doc_ids, vectors[, payloads]) batches
+        (see `add_payloads`). Up to `parallel` upserts of `batch_size` points are kept in
+        flight without waiting for them to be applied, followed by a final waiting upsert
+        that acts as consistency barrier (QDrant applies the updates of a collection in order).
+        """
+        batch_size = batch_size or settings.QDRANT_UPLOAD_BATCH_SIZE
+        parallel = parallel or settings.QDRANT_UPLOAD_PARALLEL
+        in_flight, total, last, start = set(), 0, None, time.time()
+        try:
+            async for doc_ids, vectors, *payloads in batches:
+                payloads = payloads[0] if payloads else None
+                assert len(vectors) == len(doc_ids)
+                if last is None:
+                    await self.ensure_collection(vectors.shape[1], collection_name)
+                    if collection_name is None and self.staging is not None:
+                        await self.ensure_collection(vectors.shape[1], self.staging)
+                for i in range(0, len(doc_ids), batch_size):
+                    if len(in_flight) >= parallel:
+                        done, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                        for task in done:
+                            task.result() # raise upload errors
+                    last = (vectors[i:i+batch_size], doc_ids[i:i+batch_size],
+                            payloads[i:i+batch_size] if payloads else None)
+                    in_flight.add(asyncio.create_task(
+                        self.upsert(*last, wait=False, collection_name=collection_name)))
+                total += len(doc_ids)
+            await asyncio.gather(*in_flight)
+        except BaseException:
+            for task in in_flight:
+                task.cancel()
+            raise
+        if last is not None:
+            await self.upsert(*last, wait=True, collection_name=collection_name)
+
+        elapsed = time.time() - start
+        await utils.maybe_await(logger.info("Indexed {} vectors in {:.2f} secs ({:.1f} vectors/sec)".format(
+            total, elapsed, total / max(elapsed, 1e-6))))
+        return total
     
     async def get_vectors(self):
         """
         Utility function to retrieve vectors from the database
         """
-        hits, _ = await self.qdrant_client.scroll(
-            self.collection_name, with_vectors=False, limit=500_000)
-        return hits
-    
+        hits, offset = [], None
+        while True:
+            batch, offset = await self.qdrant_client.scroll(
+                self.collection_name, with_vectors=False, limit=10_000, offset=offset)
+            hits.extend(batch)
+            if offset is None:
+                return hits
+
+    async def iter_vectors(self, batch_size=1_000):
+        """
+        Scroll over the entire collection, yielding (doc_ids, vectors) batches
+        """
+        offset = None
+        while True:
+            hits, offset = await self.qdrant_client.scroll(
+                self.collection_name, limit=batch_size, offset=offset,
+                with_payload=["doc_id"], with_vectors=True)
+            if hits:
+                yield [hit.payload["doc_id"] for hit in hits], np.array([hit.vector for hit in hits], dtype=np.float32)
+            if offset is None:
+                break
+
     async def _clear_up(self):
-        await self.qdrant_client.delete_collection(self.collection_name)
+        # deleting the collection also removes its aliases
+        version = await self.get_version()
+        if version is not None:
+            await self.qdrant_client.delete_collection(version)
+        self.ready.clear()
     
     async def close(self):
-        await self.qdrant_client.close()
\ No newline at end of file
+        await self.qdrant_client.close()
+
+def create_vector_client():
+    """
+    Instantiate the vector database client selected in the settings (`VECTOR_BACKEND`)
+    """
+    if settings.VECTOR_BACKEND == "memmap":
+        from bntl.memmap_vector import MemmapVectorClient
+        return MemmapVectorClient()
+    return VectorClient()
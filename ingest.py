@@ -7,13 +7,13 @@ import aiofiles
 
 from bntl import utils
 from bntl.db import DBClient
-from bntl.vector import VectorClient
+from bntl.vector import create_vector_client, add_payloads
 from bntl.upload import convert_to_text
 from vectorizer import client
 
 
 async def main(path):
-    vector_client = VectorClient()
+    vector_client = create_vector_client()
     db_client = await DBClient.create()
 
     async with utils.AsyncLogger() as logger:
@@ -40,15 +40,19 @@ async def main(path):
         texts = [convert_to_text(doc, ignore_keywords=True) for doc in docs]
         doc_ids = [str(doc["doc_id"]) for doc in docs]
         task_id = str(uuid.uuid4())
-        vectors = await client.vectorize(db_client.vectors_coll, task_id, texts, doc_ids, logger=logger)
+        done = await client.vectorize(task_id, texts, doc_ids, logger=logger)
 
         # insert to qdrant
-        if vectors:
+        if done:
             await logger.info("Ingesting vectors into vector database")
-            await vector_client.insert(vectors, [str(doc["doc_id"]) for doc in docs])
+            await vector_client.insert_stream(
+                add_payloads(client.download_vectors(task_id), db_client), logger=logger)
+            await client.ack_task(task_id)
         else:
             await logger.info("Vectorization task failed, check logs to see what happened.")
 
+    await client.close_session()
+
 if __name__ == '__main__':
     import argparse
     parser = argparse.ArgumentParser()
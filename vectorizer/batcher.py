@@ -0,0 +1,178 @@
+import logging
+from typing import List, Dict
+
+import numpy as np
+
+from vectorizer.settings import settings
+
+
+logger = logging.getLogger(__name__)
+
+
+class PendingTask:
+    """
+    Texts of a task still to be encoded. `texts` only holds the unique texts of the inputs
+    that were not in the cache (`hits`), and `keys` maps each input to its text (by default,
+    each input is its own text). Inputs are persisted in chunks (`chunk_sizes`) as soon as all
+    their vectors are available, and `offset` is the number of inputs persisted by previous
+    attempts of the task. Vectors are only held until the last chunk that needs them is
+    persisted (see `release`), so that memory doesn't grow with the size of the task.
+    """
+    def __init__(self, task, texts, doc_ids, lengths, keys=None, miss_keys=None, hits=None, device=None,
+                 chunk_sizes=None, offset=0) -> None:
+        self.task = task
+        self.device = device
+        self.texts = texts
+        self.doc_ids = doc_ids
+        self.lengths = lengths # number of tokens per text
+        self.keys = keys if keys is not None else list(range(len(texts)))
+        self.miss_keys = miss_keys if miss_keys is not None else self.keys
+        self.hits = hits or {}
+        position = {key: idx for idx, key in enumerate(self.miss_keys)}
+        self.miss_index = [position.get(key, -1) for key in self.keys]
+        # input at which each text is needed for the last time
+        self.last_use = {key: idx for idx, key in enumerate(self.keys)}
+        self.next = 0 # index of the next text to be encoded
+        self.encoded: Dict[int, np.ndarray] = {} # vectors by index in `texts`
+        self.n_cached = 0 # encoded texts already written to the cache
+        self.chunk_sizes = chunk_sizes if chunk_sizes is not None else ([len(doc_ids)] if doc_ids else [])
+        self.chunks_done = 0
+        self.offset = offset
+
+    @property
+    def task_id(self):
+        return self.task["task_id"]
+
+    @property
+    def remaining(self):
+        return len(self.texts) - self.next
+
+    def add_vectors(self, start, end, vectors):
+        # copy rows, so that the batch can be freed row by row
+        for idx, vector in zip(range(start, end), vectors):
+            self.encoded[idx] = np.array(vector, dtype=np.float32)
+        self.next = end
+
+    def new_encoded(self):
+        """
+        Keys and vectors of the texts encoded since the last call
+        """
+        start, self.n_cached = self.n_cached, self.next
+        if start == self.next:
+            return [], np.zeros((0, 0), dtype=np.float32)
+        return self.miss_keys[start:self.next], np.stack([self.encoded[idx] for idx in range(start, self.next)])
+
+    def get_vectors(self, start=0, end=None):
+        """
+        Vectors of a range of inputs (which must not have been released yet)
+        """
+        end = len(self.keys) if end is None else end
+        if end <= start:
+            return np.zeros((0, 0), dtype=np.float32)
+        return np.stack([self.hits[key] if idx < 0 else self.encoded[idx]
+                         for key, idx in zip(self.keys[start:end], self.miss_index[start:end])]).astype(np.float32)
+
+    def ready_chunks(self):
+        """
+        Input ranges of the next chunks whose vectors are all available
+        """
+        chunks, start = [], sum(self.chunk_sizes[:self.chunks_done])
+        for size in self.chunk_sizes[self.chunks_done:]:
+            if max(self.miss_index[start:start + size], default=-1) >= self.next:
+                break
+            chunks.append((start, start + size))
+            start += size
+        return chunks
+
+    def release(self, start, end):
+        """
+        Free the vectors of a range of persisted inputs that no later input needs
+        """
+        for idx in range(start, end):
+            key = self.keys[idx]
+            if self.last_use[key] == idx:
+                self.hits.pop(key, None)
+                self.encoded.pop(self.miss_index[idx], None)
+
+
+class MicroBatcher:
+    """
+    Pools the texts of all the tasks leased by a worker and encodes them together. Each step
+    takes a window of texts from the tasks in order of admission (up to BATCH_WINDOW times
+    the token budget), which the model manager splits into length-bucketed micro-batches,
+    so that many small tasks are encoded together, and the vectors are routed back to their tasks.
+    """
+    def __init__(self, model_manager, token_budget=None, max_batch_size=None, window=None) -> None:
+        self.model_manager = model_manager
+        self.token_budget = token_budget or settings.BATCH_TOKEN_BUDGET
+        self.max_batch_size = max_batch_size or settings.BATCH_SIZE
+        self.window = window or settings.BATCH_WINDOW
+        self.tasks: Dict[str, PendingTask] = {}
+
+    def __len__(self):
+        return sum(pending.remaining for pending in self.tasks.values())
+
+    def add(self, task, texts, doc_ids, **kwargs) -> PendingTask:
+        """
+        Admit a task into the pool (this tokenizes the texts, so better run it in a thread)
+        """
+        pending = PendingTask(task, texts, doc_ids, self.model_manager.count_tokens(texts), **kwargs)
+        self.tasks[pending.task_id] = pending
+        return pending
+
+    def remove(self, task_id) -> PendingTask:
+        return self.tasks.pop(task_id)
+
+    def finished(self) -> List[PendingTask]:
+        """
+        Remove and return the tasks whose texts have all been encoded (but not necessarily persisted)
+        """
+        done = [pending for pending in self.tasks.values() if pending.remaining == 0]
+        for pending in done:
+            self.remove(pending.task_id)
+        return done
+
+    def next_batch(self):
+        """
+        Select the texts for the next window as a list of (task, start, end) segments.
+        All tasks in a window run on the same device.
+        """
+        segments, n_tokens, max_tokens, device = [], 0, self.token_budget * self.window, None
+        for pending in self.tasks.values():
+            if pending.remaining == 0:
+                continue
+            device = device or pending.device
+            if pending.device != device:
+                continue
+            start = end = pending.next
+            while end < len(pending.texts):
+                # always take at least one text
+                if n_tokens > 0 and n_tokens + pending.lengths[end] > max_tokens:
+                    break
+                n_tokens, end = n_tokens + pending.lengths[end], end + 1
+            if end > start:
+                segments.append((pending, start, end))
+            if end < len(pending.texts):
+                break
+        return segments
+
+    def step(self):
+        """
+        Encode one window and route the vectors back to their tasks. Returns the
+        tasks that were part of the window
+        """
+        segments = self.next_batch()
+        texts, lengths = [], []
+        for pending, start, end in segments:
+            texts.extend(pending.texts[start:end])
+            lengths.extend(pending.lengths[start:end])
+        if not texts:
+            return []
+        self.model_manager.to_device(segments[0][0].device)
+        vectors = self.model_manager.encode(
+            texts, batch_size=self.max_batch_size, lengths=lengths, token_budget=self.token_budget)
+        offset = 0
+        for pending, start, end in segments:
+            pending.add_vectors(start, end, np.asarray(vectors[offset:offset + end - start]))
+            offset += end - start
+        return [pending for pending, _, _ in segments]
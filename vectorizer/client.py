@@ -1,81 +1,171 @@
 
 import time
+import json
+import struct
 import logging
-from typing import List, Union
+from typing import List, Union, Tuple, AsyncIterator
 
 import aiohttp
 import asyncio
-
-import pymongo
-from motor.motor_asyncio import AsyncIOMotorCollection
+import numpy as np
 
 from vectorizer.models import Status
 from vectorizer.settings import settings
-from vectorizer.utils import maybe_await
+from vectorizer.utils import maybe_await, decode_vector
 
 
 logger = logging.getLogger(__name__)
 
 
-async def post_task(task_id: str, texts: List[str], doc_ids: List[str]):
-    async with aiohttp.ClientSession() as session:
-        url = 'http://0.0.0.0:{}/vectorize'.format(settings.PORT)
-        data = {"task_id": task_id, "texts": texts, "doc_ids": doc_ids}
-        async with session.post(url, json=data) as resp:
-                return await resp.json()
+# shared session (connection pool) for all requests to the vectorizer
+_session: Union[None, aiohttp.ClientSession] = None
+_session_loop = None
 
 
-async def get_task_status(task_id: str):
-    async with aiohttp.ClientSession() as session:
-        async with session.get(
-            'http://0.0.0.0:{}/check-status/{}'.format(settings.PORT, task_id)) as resp:
+def get_url(path: str) -> str:
+    return 'http://0.0.0.0:{}/{}'.format(settings.PORT, path)
+
+
+def get_session() -> aiohttp.ClientSession:
+    global _session, _session_loop
+    # sessions are bound to the event loop they were created in
+    if _session is None or _session.closed or _session_loop is not asyncio.get_running_loop():
+        _session_loop = asyncio.get_running_loop()
+        _session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=None, sock_read=settings.STATUS_POLL_TIMEOUT + 30))
+    return _session
+
+
+async def close_session():
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+
+async def post_task(task_id: str, texts: List[str], doc_ids: List[str], priority: int=0):
+    data = {"task_id": task_id, "texts": texts, "doc_ids": doc_ids, "priority": priority}
+    async with get_session().post(get_url('vectorize'), json=data) as resp:
+        return await resp.json()
+
+
+async def post_task_stream(task_id: str, texts: List[str], doc_ids: List[str], priority: int=0,
+                           chunk_size: int=1_000):
+    """
+    Submit a task as a stream of newline-delimited json, which the vectorizer stores in
+    chunks as it reads it (instead of parsing one large json body)
+    """
+    async def body():
+        for start in range(0, len(texts), chunk_size):
+            yield "".join(json.dumps({"text": text, "doc_id": doc_id}) + "\n" for text, doc_id in zip(
+                texts[start:start + chunk_size], doc_ids[start:start + chunk_size])).encode()
+
+    async with get_session().post(
+            get_url('vectorize-stream'), params={"task_id": task_id, "priority": priority},
+            data=body(), headers={"Content-Type": "application/x-ndjson"}) as resp:
+        return await resp.json()
+
+
+async def ack_task(task_id: str):
+    """
+    Let the vectorizer know that the vectors of a task were ingested and can be removed
+    (if this fails, the vectors are removed anyway after VECTORS_TTL)
+    """
+    try:
+        async with get_session().post(get_url('ack/{}'.format(task_id))) as resp:
             return await resp.json()
-        
+    except aiohttp.ClientError as e:
+        logger.info("Couldn't acknowledge task [{}]: {}".format(task_id, e))
 
-def get_retry_time(n_docs):
-    if n_docs > 50_000:
-        return 120
-    elif n_docs > 10_000:
-        return 40
-    elif n_docs > 1_000:
-        return 20
-    return 10
 
+async def get_task_status(task_id: str):
+    async with get_session().get(get_url('check-status/{}'.format(task_id))) as resp:
+        return await resp.json()
 
-async def vectorize(vectors_coll: AsyncIOMotorCollection, task_id: str, 
-                    texts: List[str], doc_ids: Union[None, List[str]]=None, 
+
+async def wait_task_status(task_id: str, status: Union[None, str]=None, progress: Union[None, int]=None,
+                           timeout: Union[None, float]=None):
+    """
+    Long-poll the task status, returning as soon as it differs from `status` (or `progress`)
+    """
+    params = {"status": status} if status else {}
+    if progress is not None:
+        params["progress"] = progress
+    if timeout:
+        params["timeout"] = timeout
+    async with get_session().get(get_url('wait-status/{}'.format(task_id)), params=params) as resp:
+        return await resp.json()
+
+
+async def vectorize(task_id: str, texts: List[str], doc_ids: Union[None, List[str]]=None, 
                     retry_time: Union[None, float]=None, timeout: float=3600 * 2,
-                    logger=logger) -> Union[List[float] | None]:
+                    priority: int=0, logger=logger) -> bool:
     """
-    Start vectorize task and monitor the status until done, error or timeout
+    Start vectorize task and monitor the status until done, error or timeout. The status
+    is long-polled, so that the call returns as soon as the task is done. `retry_time`
+    bounds how long each status request is held open. Tasks with higher `priority` are
+    processed first by the vectorizer workers.
+    Once done, the vectors can be retrieved with `download_vectors`.
     """
-    retry_time = retry_time or get_retry_time(len(texts))
-    resp = await post_task(task_id, texts, doc_ids or list(map(str, range(len(texts)))))
+    retry_time = retry_time or settings.STATUS_POLL_TIMEOUT
+    resp = await post_task_stream(
+        task_id, texts, doc_ids or list(map(str, range(len(texts)))), priority=priority)
 
     # handle 500's, etc...
-    if "status_code" in resp:
+    if "status_code" in resp or "detail" in resp:
         await maybe_await(logger.info(str(resp)))
-        return 
+        return False
 
-    start = time.time()
+    start, last_status, last_progress = time.time(), None, 0
     while resp["current_status"]["status"] != Status.DONE:
+        status = resp["current_status"]["status"]
         # exit if timeout
-        if (time.time() - start) > timeout:
+        remaining = timeout - (time.time() - start)
+        if remaining <= 0:
             await maybe_await(logger.info("Client timeout when vectorizing..."))
-            return
+            return False
         # check if error
-        if resp["current_status"]["status"] in (Status.RETRYING, Status.VECTORIZING):
-            await maybe_await(logger.info("Task in status: {}".format(resp["current_status"]["status"])))
-            await maybe_await(logger.info("Sleeping for {} seconds...".format(retry_time)))
-            await asyncio.sleep(retry_time)
-            resp = await get_task_status(task_id)
+        if status in (Status.QUEUED, Status.RETRYING, Status.VECTORIZING):
+            if status != last_status:
+                await maybe_await(logger.info("Task in status: {}".format(status)))
+                last_status = status
+            progress = resp.get("progress", 0)
+            if progress != last_progress:
+                await maybe_await(logger.info("Vectorized {}/{} texts".format(progress, resp.get("n_texts", len(texts)))))
+                last_progress = progress
+            resp = await wait_task_status(
+                task_id, status=status, progress=progress, timeout=min(retry_time, remaining))
+            if "detail" in resp:
+                await maybe_await(logger.info(str(resp)))
+                return False
         else:
             await maybe_await(logger.info("Error while vectorizing..."))
-            await maybe_await(logger.info(str(resp["current_status"]["status"])))
-            return
+            await maybe_await(logger.info(str(status)))
+            return False
     else: # done
         await maybe_await(logger.info("Vectorization done in {} secs".format(round(time.time() - start, 2))))
-        vectors = await vectors_coll.find(
-            {"task_id": task_id}
-        ).sort("vector_id", pymongo.DESCENDING).to_list(length=None)
-        return [item["vector"] for item in vectors]
+        return True
+
+
+async def download_vectors(task_id: str, batch_size: int=1_000) -> AsyncIterator[Tuple[List[str], np.ndarray]]:
+    """
+    Stream the vectors of a finished task over HTTP in (doc_ids, vectors) batches, so that
+    they can be handed over to the vector database without loading them all in memory
+    """
+    async with get_session().get(get_url('vectors/{}'.format(task_id))) as resp:
+        resp.raise_for_status()
+        dtype = resp.headers.get("X-Vector-Dtype", settings.VECTOR_DTYPE)
+        doc_ids, vectors = [], []
+        while True:
+            try:
+                (doc_id_len,) = struct.unpack("<H", await resp.content.readexactly(2))
+            except asyncio.IncompleteReadError:
+                break
+            doc_ids.append((await resp.content.readexactly(doc_id_len)).decode())
+            (vector_len,) = struct.unpack("<I", await resp.content.readexactly(4))
+            vectors.append(decode_vector(await resp.content.readexactly(vector_len), dtype))
+            if len(doc_ids) == batch_size:
+                yield doc_ids, np.stack(vectors)
+                doc_ids, vectors = [], []
+        if doc_ids:
+            yield doc_ids, np.stack(vectors)
@@ -1,23 +1,42 @@
 
+import time
+import struct
+import asyncio
 import logging
-from datetime import datetime, timezone
+from datetime import datetime, timezone, timedelta
 
 import motor.motor_asyncio as motor
-from pymongo import UpdateOne
+import pymongo
+from pymongo import InsertOne, UpdateOne, ReturnDocument, ASCENDING, DESCENDING
 
 from vectorizer.models import TaskModel, VectorModel, Status, create_new_status
 from vectorizer.settings import settings
+from vectorizer.utils import encode_vector, decode_vector
 
 from bntl.settings import settings as bntl_settings
 
 logger = logging.getLogger(__name__)
 
 
+def status_pipeline(status, extra=None, **status_info):
+    """
+    Update pipeline that moves the current status of a task into its history
+    """
+    return [{"$set": {
+        "history": {"$concatArrays": [{"$ifNull": ["$history", []]}, ["$current_status"]]},
+        "current_status": {"$literal": create_new_status(status, **status_info).model_dump()},
+        **(extra or {})}}]
+
+
 class DBClient():
     def __init__(self, ) -> None:
         self.db_client = motor.AsyncIOMotorClient(bntl_settings.LOCAL_URI)
         self.tasks_coll = self.db_client[settings.VECTORIZER_DB][settings.TASKS_COLL]
         self.vectors_coll = self.db_client[settings.VECTORIZER_DB][settings.VECTORS_COLL]
+        self.inputs_coll = self.db_client[settings.VECTORIZER_DB][settings.INPUTS_COLL]
+        self.cache_coll = self.db_client[settings.VECTORIZER_DB][settings.CACHE_COLL]
+        # notified on every status update issued by this process
+        self.status_changed = asyncio.Condition()
 
     @classmethod
     async def create(cls):
@@ -30,49 +49,335 @@ class DBClient():
         logger.info("Creating DB indices")
         await self.tasks_coll.create_index("task_id", unique=True)
         await self.vectors_coll.create_index(["task_id", "vector_id", "doc_id"], unique=True)
+        await self.inputs_coll.create_index(["task_id", "chunk_id"], unique=True)
+        await self.cache_coll.create_index("model")
+        await self.tasks_coll.create_index(
+            [("current_status.status", ASCENDING), ("priority", DESCENDING), ("date_created", ASCENDING)])
     
     def close(self):
         self.db_client.close()
 
-    async def create_task(self, task_id, texts, doc_ids) -> TaskModel:
-        # create task
+    async def create_task(self, task_id, texts, doc_ids, priority=0) -> TaskModel:
+        chunk_size = settings.INPUT_CHUNK_SIZE
+
+        async def chunks():
+            for start in range(0, len(texts), chunk_size):
+                yield texts[start:start + chunk_size], doc_ids[start:start + chunk_size]
+
+        return await self.create_task_from_chunks(task_id, chunks(), priority=priority)
+
+    async def create_task_from_chunks(self, task_id, chunks, priority=0) -> TaskModel:
+        """
+        Enqueue a task from an (async) stream of (texts, doc_ids) chunks. The inputs are
+        stored chunk by chunk before the task itself, so that workers never lease a task
+        with missing inputs.
+        """
+        if await self.get_task(task_id):
+            raise pymongo.errors.DuplicateKeyError(f"Task [{task_id}] already exists")
+        n_texts = 0
+        try:
+            chunk_id = 0
+            async for texts, doc_ids in chunks:
+                if not texts:
+                    continue
+                await self.inputs_coll.insert_one(
+                    {"task_id": task_id, "chunk_id": chunk_id, "texts": texts, "doc_ids": doc_ids})
+                chunk_id += 1
+                n_texts += len(texts)
+        except pymongo.errors.DuplicateKeyError:
+            raise
+        except Exception:
+            # incomplete input
+            await self.delete_inputs(task_id)
+            raise
+        now = datetime.now(timezone.utc)
         task = TaskModel(task_id=task_id,
-                         current_status=create_new_status(Status.VECTORIZING),
-                         date_created=datetime.now(timezone.utc))
+                         current_status=create_new_status(Status.QUEUED),
+                         date_created=now,
+                         priority=priority,
+                         n_texts=n_texts,
+                         available_at=now)
         await self.tasks_coll.insert_one(task.model_dump())
-        # create vector entries
-        await self.vectors_coll.insert_many(
-            [VectorModel(task_id=task_id, vector_id=idx, doc_id=doc_id, text=text).model_dump()
-             for idx, (text, doc_id) in enumerate(zip(texts, doc_ids))])
+        async with self.status_changed:
+            self.status_changed.notify_all()
         # done
-        logger.info(f"Created task [{task_id}]")
+        logger.info(f"Created task [{task_id}] with {n_texts} texts")
         return task.model_dump()
-    
+
+    async def iter_inputs(self, task_id, from_chunk=0):
+        """
+        Yield the (texts, doc_ids) chunks of a task in input order
+        """
+        async for chunk in self.inputs_coll.find(
+                {"task_id": task_id, "chunk_id": {"$gte": from_chunk}}).sort("chunk_id", ASCENDING):
+            yield chunk["texts"], chunk["doc_ids"]
+
+    async def delete_inputs(self, task_id):
+        await self.inputs_coll.delete_many({"task_id": task_id})
+
     async def get_task(self, task_id):
         doc = await self.tasks_coll.find_one({"task_id": task_id})
-        doc.pop("_id")
+        if doc:
+            doc.pop("_id")
         return doc
 
-    async def update_task_status(self, task_id, status, **status_info):
-        old_status = (await self.get_task(task_id))["current_status"]
-        # update task status
+    async def wait_task(self, task_id, status=None, progress=None, timeout=30):
+        """
+        Long-poll a task until its status differs from `status` (or its progress from
+        `progress`, if given) or the timeout expires.
+        Updates from this process wake up the waiters immediately, while updates from other
+        processes are picked up by re-checking the database every STATUS_CHECK_INTERVAL secs.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            task = await self.get_task(task_id)
+            remaining = deadline - time.monotonic()
+            if task is None or task["current_status"]["status"] != status or remaining <= 0 or (
+                    progress is not None and task.get("progress", 0) != progress):
+                return task
+            async with self.status_changed:
+                try:
+                    await asyncio.wait_for(
+                        self.status_changed.wait(), min(remaining, settings.STATUS_CHECK_INTERVAL))
+                except asyncio.TimeoutError:
+                    pass
+
+    async def wait_status_change(self, timeout):
+        """
+        Wait until a task is created or updated in this process (or the timeout expires)
+        """
+        async with self.status_changed:
+            try:
+                await asyncio.wait_for(self.status_changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def update_task_status(self, task_id, status, worker_id=None, **status_info):
+        """
+        Update the status of a task, releasing its lease. If `worker_id` is given, the
+        update only goes through if the worker still holds the lease.
+        """
+        query = {"task_id": task_id}
+        if worker_id is not None:
+            query["lease_owner"] = worker_id
         task_update = await self.tasks_coll.update_one(
-            {"task_id": task_id}, 
-            {"$set": {"current_status": create_new_status(status, **status_info).model_dump()},
-             "$push": {"history": old_status}}, 
-             upsert=True)
+            query, status_pipeline(status, extra={"lease_owner": None, "lease_expires": None}, **status_info))
+        async with self.status_changed:
+            self.status_changed.notify_all()
         logger.info(f"Task [{task_id}] updated to status: {status}")
         logger.info("Status info: " + str(status_info))
         return task_update
+
+    # queue
+    async def lease_task(self, worker_id, lease_time=None):
+        """
+        Atomically lease the next available task: queued tasks or tasks whose retry delay
+        has passed, as well as tasks whose lease expired (i.e. their worker died). Tasks
+        are served by descending priority and then in order of creation.
+        """
+        now = datetime.now(timezone.utc)
+        lease_time = lease_time or settings.QUEUE_LEASE_TIME
+        task = await self.tasks_coll.find_one_and_update(
+            {"$or": [{"current_status.status": {"$in": [Status.QUEUED, Status.RETRYING]},
+                      "available_at": {"$lte": now}},
+                     {"current_status.status": Status.VECTORIZING,
+                      "lease_expires": {"$lt": now}}],
+             "attempts": {"$lt": settings.MAX_RETRIES}},
+            status_pipeline(Status.VECTORIZING,
+                            extra={"lease_owner": {"$literal": worker_id},
+                                   "lease_expires": now + timedelta(seconds=lease_time),
+                                   "attempts": {"$add": ["$attempts", 1]}},
+                            worker=worker_id),
+            sort=[("priority", DESCENDING), ("date_created", ASCENDING)],
+            projection={"_id": 0},
+            return_document=ReturnDocument.AFTER)
+        if task is not None:
+            async with self.status_changed:
+                self.status_changed.notify_all()
+            logger.info(f"Worker [{worker_id}] leased task [{task['task_id']}] (attempt {task['attempts']})")
+        return task
+
+    async def heartbeat(self, task_id, worker_id, lease_time=None):
+        """
+        Extend the lease of a task, returning False if the worker lost it
+        """
+        lease_time = lease_time or settings.QUEUE_LEASE_TIME
+        result = await self.tasks_coll.update_one(
+            {"task_id": task_id, "lease_owner": worker_id, "current_status.status": Status.VECTORIZING},
+            {"$set": {"lease_expires": datetime.now(timezone.utc) + timedelta(seconds=lease_time)}})
+        return result.matched_count > 0
+
+    async def update_progress(self, task_id, worker_id, progress, chunks_done):
+        """
+        Record the number of inputs (and input chunks) whose vectors have been stored
+        """
+        await self.tasks_coll.update_one(
+            {"task_id": task_id, "lease_owner": worker_id},
+            {"$set": {"progress": progress, "chunks_done": chunks_done}})
+        async with self.status_changed:
+            self.status_changed.notify_all()
+
+    async def retry_task(self, task_id, worker_id, delay, extra=None, **status_info):
+        """
+        Put a leased task back into the queue after `delay` seconds, or give up on it
+        if it ran out of attempts. `extra` fields are set on the task.
+        """
+        task = await self.get_task(task_id)
+        if task["attempts"] >= settings.MAX_RETRIES:
+            return await self.update_task_status(task_id, Status.OUTOFATTEMPTS, worker_id=worker_id, **status_info)
+        result = await self.tasks_coll.update_one(
+            {"task_id": task_id, "lease_owner": worker_id},
+            status_pipeline(Status.RETRYING,
+                            extra={"lease_owner": None, "lease_expires": None,
+                                   "available_at": datetime.now(timezone.utc) + timedelta(seconds=delay),
+                                   **(extra or {})},
+                            attempts=task["attempts"], **status_info))
+        async with self.status_changed:
+            self.status_changed.notify_all()
+        logger.info(f"Task [{task_id}] will be retried in {delay} secs")
+        return result
+
+    async def expire_tasks(self):
+        """
+        Give up on tasks whose lease expired after their last attempt
+        """
+        result = await self.tasks_coll.update_many(
+            {"current_status.status": Status.VECTORIZING,
+             "lease_expires": {"$lt": datetime.now(timezone.utc)},
+             "attempts": {"$gte": settings.MAX_RETRIES}},
+            status_pipeline(Status.OUTOFATTEMPTS, extra={"lease_owner": None, "lease_expires": None},
+                            message="Lease expired"))
+        if result.modified_count:
+            logger.info(f"Expired {result.modified_count} tasks")
+        return result.modified_count
+
+    async def store_vectors(self, task_id, vectors, doc_ids, start_id=0, batch_size=1_000):
+        """
+        Store vectors as packed binary blobs using unordered bulk inserts. `start_id` is
+        the position of the first vector in the task inputs.
+        """
+        dtype = settings.VECTOR_DTYPE
+        for start in range(0, len(doc_ids), batch_size):
+            await self.vectors_coll.bulk_write(
+                [InsertOne(VectorModel(task_id=task_id, doc_id=doc_id, vector_id=vector_id,
+                                       vector=encode_vector(vector, dtype), dtype=dtype).model_dump())
+                 for vector_id, (doc_id, vector) in enumerate(
+                     zip(doc_ids[start:start + batch_size], vectors[start:start + batch_size]), start_id + start)],
+                ordered=False)
     
-    async def store_vectors(self, task_id, vectors, doc_ids):
-        await self.vectors_coll.bulk_write(
-            [UpdateOne({"task_id": task_id, "doc_id": doc_id, "vector_id": vector_id},
-                        {"$set": {"vector": vector}})
-                for vector_id, (doc_id, vector) in enumerate(zip(doc_ids, vectors))])
-    
+    # embedding cache
+    async def get_cached(self, model_name, keys, batch_size=10_000):
+        """
+        Bulk lookup of cached embeddings by content address (see `utils.cache_key`)
+        """
+        hits = {}
+        for start in range(0, len(keys), batch_size):
+            async for item in self.cache_coll.find(
+                    {"_id": {"$in": keys[start:start + batch_size]}, "model": model_name}):
+                hits[bytes(item["_id"])] = decode_vector(item["vector"], item["dtype"])
+        return hits
+
+    async def cache_vectors(self, model_name, keys, vectors, batch_size=1_000):
+        dtype = settings.VECTOR_DTYPE
+        for start in range(0, len(keys), batch_size):
+            await self.cache_coll.bulk_write(
+                [UpdateOne({"_id": key},
+                           {"$setOnInsert": {"model": model_name, "vector": encode_vector(vector, dtype), "dtype": dtype}},
+                           upsert=True)
+                 for key, vector in zip(keys[start:start + batch_size], vectors[start:start + batch_size])],
+                ordered=False)
+
+    async def iter_packed_vectors(self, task_id, dtype=None, batch_size=1_000):
+        """
+        Stream the vectors of a task in input order as binary frames: the length of the
+        doc_id (uint16), the utf-8 doc_id, the length of the vector blob (uint32) and the blob
+        """
+        dtype = dtype or settings.VECTOR_DTYPE
+        cursor = self.vectors_coll.find(
+            {"task_id": task_id}, {"_id": 0, "doc_id": 1, "vector": 1, "dtype": 1}
+        ).sort("vector_id", ASCENDING).batch_size(batch_size)
+        frames = []
+        async for item in cursor:
+            vector = item["vector"]
+            if item["dtype"] != dtype:
+                vector = encode_vector(decode_vector(vector, item["dtype"]), dtype)
+            doc_id = item["doc_id"].encode()
+            frames.append(struct.pack("<H", len(doc_id)) + doc_id + struct.pack("<I", len(vector)) + bytes(vector))
+            if len(frames) == batch_size:
+                yield b"".join(frames)
+                frames = []
+        if frames:
+            yield b"".join(frames)
+
+    # retention
+    async def ack_task(self, task_id):
+        """
+        Acknowledge that the vectors of a finished task were ingested by the caller, so
+        that they can be removed by the next garbage collection
+        """
+        result = await self.tasks_coll.update_one(
+            {"task_id": task_id, "current_status.status": Status.DONE},
+            {"$set": {"acked_at": datetime.now(timezone.utc)}})
+        return result.matched_count > 0
+
+    async def payload_size(self, coll, task_ids, batch_size=1_000):
+        """
+        Number of documents and total BSON size of the data of the given tasks in a collection
+        """
+        stats = {"documents": 0, "bytes": 0}
+        for start in range(0, len(task_ids), batch_size):
+            async for item in coll.aggregate([
+                    {"$match": {"task_id": {"$in": task_ids[start:start + batch_size]}}},
+                    {"$group": {"_id": None, "documents": {"$sum": 1}, "bytes": {"$sum": {"$bsonSize": "$$ROOT"}}}}]):
+                stats["documents"] += item["documents"]
+                stats["bytes"] += item["bytes"]
+        return stats
+
+    async def collect_garbage(self, ttl=None, dry_run=False, batch_size=1_000):
+        """
+        Remove the vectors and inputs of acknowledged tasks and of tasks that ended more
+        than `ttl` secs ago (the task documents themselves are kept, marked as compacted).
+        Returns a report with the number of tasks, documents and bytes reclaimed.
+        """
+        ttl = settings.VECTORS_TTL if ttl is None else ttl
+        cutoff = datetime.now(timezone.utc) - timedelta(seconds=ttl)
+        ended = [Status.DONE, Status.RUNTIMEERROR, Status.OUTOFATTEMPTS, Status.TIMEOUT, Status.UNKNOWNERROR]
+        task_ids = [item["task_id"] async for item in self.tasks_coll.find(
+            {"compacted_at": None,
+             "$or": [{"acked_at": {"$ne": None}},
+                     {"current_status.status": {"$in": ended}, "current_status.date_created": {"$lt": cutoff}}]},
+            {"_id": 0, "task_id": 1})]
+        report = {"tasks": len(task_ids)}
+        for name, coll in [("vectors", self.vectors_coll), ("inputs", self.inputs_coll)]:
+            report[name] = await self.payload_size(coll, task_ids)
+            if dry_run:
+                continue
+            for start in range(0, len(task_ids), batch_size):
+                await coll.delete_many({"task_id": {"$in": task_ids[start:start + batch_size]}})
+        if not dry_run and task_ids:
+            await self.tasks_coll.update_many(
+                {"task_id": {"$in": task_ids}}, {"$set": {"compacted_at": datetime.now(timezone.utc)}})
+        report["bytes"] = report["vectors"]["bytes"] + report["inputs"]["bytes"]
+        logger.info("Garbage collection{}: {}".format(" (dry run)" if dry_run else "", report))
+        return report
+
+    async def compact(self):
+        """
+        Hand the space freed by deleted documents back to the filesystem, returning the
+        storage size of the collections before and after
+        """
+        db = self.db_client[settings.VECTORIZER_DB]
+        report = {}
+        for coll in [self.vectors_coll, self.inputs_coll]:
+            before = (await db.command("collStats", coll.name))["storageSize"]
+            await db.command("compact", coll.name)
+            after = (await db.command("collStats", coll.name))["storageSize"]
+            report[coll.name] = {"before": before, "after": after}
+        return report
+
     async def _clear_up(self):
         await self.vectors_coll.drop()
+        await self.inputs_coll.drop()
         await self.tasks_coll.drop()
         # ensure we recreate the indices
         await self.ensure_indices()
\ No newline at end of file
@@ -1,17 +1,80 @@
 
+import os
+import time
 import logging
 
+import numpy as np
 import torch
 from sentence_transformers import SentenceTransformer
 from FlagEmbedding import BGEM3FlagModel
 
+from vectorizer.settings import settings
+
 logger = logging.getLogger(__name__)
 
 
+def make_batches(lengths, token_budget, max_batch_size):
+    """
+    Group text indices into batches of similar length, starting with the longest texts
+    (so that out-of-memory errors surface early). A batch is closed once adding another
+    text would exceed the token budget, counting padding to the longest text in the batch.
+    """
+    order = np.argsort(-np.asarray(lengths), kind="stable")
+    batches, batch, max_len = [], [], 0
+    for idx in order:
+        max_len = max_len or lengths[idx]
+        if batch and (len(batch) >= max_batch_size or (len(batch) + 1) * max_len > token_budget):
+            batches.append(batch)
+            batch, max_len = [], lengths[idx]
+        batch.append(int(idx))
+    if batch:
+        batches.append(batch)
+    return batches
+
+
 class ModelManager:
+    """
+    Wraps an embedding model. The model is kept on the GPU between tasks and only moved
+    back to the CPU once it has been idle for MODEL_IDLE_TIMEOUT secs or when GPU memory
+    runs low (see `maybe_evict`). Transfers are counted and timed in `stats`.
+    """
+    # precision of the (non-quantized) weights
+    dtype = "fp32"
+    # keyword arguments of `encode` that change the embeddings
+    encode_options = {}
+
     def __init__(self, model_name) -> None:
         self.model_name = model_name
         self.model = None
+        self.device = None
+        self.quantized = False
+        self.last_used = time.monotonic()
+        self.stats = {"to_gpu": 0, "to_gpu_secs": 0.0, "to_cpu": 0, "to_cpu_secs": 0.0, "evictions": 0}
+
+    @property
+    def quantize(self):
+        """
+        Whether the model runs with int8 weights on this host (see `to_device`)
+        """
+        # quantized weights can't go back to the GPU, so only quantize on GPU-less hosts
+        return settings.CPU_QUANTIZE and not torch.cuda.is_available()
+
+    @property
+    def precision(self):
+        """
+        Precision the embeddings are computed with
+        """
+        return "int8" if self.quantize else self.dtype
+
+    @property
+    def cache_name(self):
+        """
+        Identifies the embeddings of this model in the cache. It includes every setting that
+        changes the embeddings (model, truncation, precision and encoding options), since
+        cache entries are never overwritten: changing any of them starts a new cache.
+        """
+        options = ["{}={}".format(key, value) for key, value in sorted(self.encode_options.items())]
+        return ":".join([self.model_name, str(settings.MAX_SEQ_LENGTH), self.precision] + options)
 
     def get_model(self):
         if self.model is None:
@@ -21,62 +84,159 @@ class ModelManager:
     def load_model(self):
         raise NotImplementedError
 
-    def move_model_to_cpu(self):
+    def _to_device(self, device):
         raise NotImplementedError
+
+    def _move(self, device):
+        if self.model is None or self.device == device:
+            return
+        logger.info("Moving model to {}...".format(device))
+        start = time.time()
+        self._to_device(device)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+            if device == "cpu":
+                # hand the cached blocks back to other processes
+                torch.cuda.empty_cache()
+        elapsed = time.time() - start
+        self.device = device
+        key = "to_gpu" if device == "cuda" else "to_cpu"
+        self.stats[key] += 1
+        self.stats[key + "_secs"] += elapsed
+        logger.info("Model moved to {} in {:.2f} secs (transfers: {})".format(device, elapsed, self.stats))
+
+    def move_model_to_cpu(self):
+        self._move("cpu")
     
     def move_model_to_gpu(self):
-        raise NotImplementedError
+        self._move("cuda")
+        self.last_used = time.monotonic()
+
+    def select_device(self):
+        """
+        Device to run on: the GPU if available (unless DEVICE is "cpu") or else the CPU
+        (unless DEVICE is "cuda", in which case None is returned and tasks wait for a GPU)
+        """
+        if settings.DEVICE != "cpu" and torch.cuda.is_available():
+            return "cuda"
+        if settings.DEVICE == "cuda":
+            return None
+        return "cpu"
+
+    def to_device(self, device):
+        """
+        Get the model ready to encode on the given device
+        """
+        self.load_model()
+        if device == "cuda":
+            self.move_model_to_gpu()
+            return
+        self.move_model_to_cpu()
+        torch.set_num_threads(settings.CPU_THREADS or os.cpu_count())
+        if self.quantize and not self.quantized:
+            logger.info("Quantizing model to int8...")
+            self._quantize()
+            self.quantized = True
+        self.last_used = time.monotonic()
+
+    def _quantize(self):
+        self.model = torch.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+
+    def maybe_evict(self, idle_timeout=None, min_free_memory=None):
+        """
+        Move the model back to the CPU if it has been idle for longer than `idle_timeout`
+        secs or if the free GPU memory drops below `min_free_memory` (as a fraction)
+        """
+        if self.device != "cuda":
+            return False
+        idle_timeout = settings.MODEL_IDLE_TIMEOUT if idle_timeout is None else idle_timeout
+        min_free_memory = settings.MODEL_MIN_FREE_MEMORY if min_free_memory is None else min_free_memory
+        idle = time.monotonic() - self.last_used
+        if idle < idle_timeout:
+            free, total = torch.cuda.mem_get_info()
+            if free / total >= min_free_memory:
+                return False
+            logger.info("Low GPU memory ({:.1%} free)".format(free / total))
+        self.move_model_to_cpu()
+        self.stats["evictions"] += 1
+        return True
     
     def close(self):
         if self.model:
             self.move_model_to_cpu()
         del self.model
 
-    def encode(self, text, batch_size):
-        return self.model.encode(text, batch_size=batch_size)
+    def _encode(self, texts, batch_size):
+        return self.model.encode(texts, batch_size=batch_size, **self.encode_options)
+
+    def encode(self, texts, batch_size=None, lengths=None, token_budget=None):
+        """
+        Encode texts in batches of similar length: texts are sorted by number of tokens
+        and batched under a token budget (batch size times the longest text), so that
+        batches of short texts are larger and little compute is spent on padding.
+        Vectors are returned in the original order.
+        """
+        self.last_used = time.monotonic()
+        if not texts:
+            return np.zeros((0, 0), dtype=np.float32)
+        lengths = lengths if lengths is not None else self.count_tokens(texts)
+        vectors = None
+        for batch in make_batches(lengths, token_budget or settings.BATCH_TOKEN_BUDGET,
+                                  batch_size or settings.BATCH_SIZE):
+            batch_vectors = np.asarray(self._encode([texts[i] for i in batch], len(batch)))
+            if vectors is None:
+                vectors = np.zeros((len(texts), batch_vectors.shape[1]), dtype=batch_vectors.dtype)
+            vectors[batch] = batch_vectors
+            self.last_used = time.monotonic()
+        return vectors
+
+    def get_tokenizer(self):
+        return self.model.tokenizer
+
+    def count_tokens(self, texts):
+        """
+        Number of tokens per text (including special tokens), capped at MAX_SEQ_LENGTH
+        """
+        self.load_model()
+        if not texts:
+            return []
+        return [min(len(ids), settings.MAX_SEQ_LENGTH)
+                for ids in self.get_tokenizer()(texts, add_special_tokens=True)["input_ids"]]
 
 
 class ModelManagerStella(ModelManager):
+    encode_options = {"prompt_name": "s2s_query"}
+
     def load_model(self):
         if self.model is None:
             self.model = SentenceTransformer(self.model_name, trust_remote_code=True)
+            self.model.max_seq_length = settings.MAX_SEQ_LENGTH
             logger.info("Loaded model")
+            self.device = self.model.device.type
             self.move_model_to_cpu()
 
-    def move_model_to_gpu(self):
-        if self.model.device != torch.device('cuda'):
-            logger.info("Moving model to GPU...")
-            self.model = self.model.to(torch.device('cuda'))
-            logger.info("Model moved to GPU.")
-
-    def move_model_to_cpu(self):
-        if self.model.device != torch.device('cpu'):
-            logger.info("Moving model back to CPU...")
-            self.model = self.model.to(torch.device('cpu'))
-            logger.info("Model moved back to CPU.")
-
-    def encode(self, text, batch_size):
-        return self.model.encode(text, batch_size=batch_size, prompt_name='s2s_query')
+    def _to_device(self, device):
+        self.model = self.model.to(torch.device(device))
 
 
 class ModelManagerFE(ModelManager):
+    dtype = "fp16"
+
     def load_model(self):
         if self.model is None:
-            self.model = BGEM3FlagModel(self.model_name, use_fp16=True)      
+            self.model = BGEM3FlagModel(self.model_name, use_fp16=self.dtype == "fp16")
             logger.info("Loaded model")  
+            self.device = next(self.model.model.parameters()).device.type
             self.move_model_to_cpu()
 
-    def move_model_to_gpu(self):
-        logger.info("Moving model to GPU...")
-        self.model.model.cuda()
-        logger.info("Model moved to GPU.")
+    def _to_device(self, device):
+        self.model.model.to(torch.device(device))
 
-    def move_model_to_cpu(self):
-        logger.info("Moving model back to CPU...")
-        self.model.model.cpu()
-        logger.info("Model moved back to CPU.")
+    def _quantize(self):
+        self.model.model = torch.quantization.quantize_dynamic(
+            self.model.model, {torch.nn.Linear}, dtype=torch.qint8)
 
-    def encode(self, text, batch_size):
-        logger.info("Vectorizing {} texts...".format(len(text)))
-        return self.model.encode(text, batch_size=batch_size)["dense_vecs"]
+    def _encode(self, texts, batch_size):
+        return self.model.encode(
+            texts, batch_size=batch_size, max_length=settings.MAX_SEQ_LENGTH, **self.encode_options)["dense_vecs"]
     
\ No newline at end of file
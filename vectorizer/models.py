@@ -6,6 +6,7 @@ from pydantic import BaseModel
 
 
 class Status:
+    QUEUED = 'Queued'
     DONE = 'Done!'
     RETRYING = 'Retrying...'
     VECTORIZING = 'Vectorizing...'
@@ -30,17 +31,32 @@ class TaskModel(BaseModel):
     date_created: datetime
     current_status: StatusModel
     history: Optional[List[StatusModel]] = []
+    n_texts: int = 0
+    progress: int = 0 # number of inputs whose vectors are stored
+    chunks_done: int = 0 # number of input chunks whose vectors are stored
+    # queue
+    priority: int = 0 # higher priority tasks are leased first
+    attempts: int = 0
+    available_at: Optional[datetime] = None # retried tasks wait until this date
+    lease_owner: Optional[str] = None # worker processing the task
+    lease_expires: Optional[datetime] = None # renewed by the worker heartbeat
+    ooms: int = 0 # number of GPU out-of-memory errors
+    device: Optional[str] = None # forces the task on a device (e.g. "cpu" after repeated OOMs)
+    # retention
+    acked_at: Optional[datetime] = None # the caller ingested the vectors
+    compacted_at: Optional[datetime] = None # the vectors and inputs were removed
 
 
 class VectorModel(BaseModel):
     task_id: str
     doc_id: str # doc_id mapping to bntl.doc_id
     vector_id: int # just an integer to index input order
-    text: str
-    vector: Optional[List[float]] = []
+    vector: bytes # packed binary vector (see vectorizer.utils.encode_vector)
+    dtype: str # type of the packed vector
 
 
 class VectorizeParams(BaseModel):
     task_id: str
     texts: List[str]
-    doc_ids: List[str]
\ No newline at end of file
+    doc_ids: List[str]
+    priority: int = 0 # higher priority tasks are leased first
@@ -0,0 +1,29 @@
+import json
+import asyncio
+
+from vectorizer.settings import settings
+from vectorizer.db import DBClient
+
+
+async def main(ttl=None, dry_run=False, compact=False):
+    db_client = await DBClient.create()
+    try:
+        report = await db_client.collect_garbage(ttl=ttl, dry_run=dry_run)
+        if compact and not dry_run:
+            report["storage"] = await db_client.compact()
+        print(json.dumps(report, indent=2))
+    finally:
+        db_client.close()
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Remove the vectors and inputs of finished vectorizer tasks")
+    parser.add_argument('--ttl', type=int, default=settings.VECTORS_TTL,
+                        help="Remove data of tasks that ended more than ttl secs ago (acknowledged tasks are always removed)")
+    parser.add_argument('--dry-run', action='store_true', help="Only report what would be removed")
+    parser.add_argument('--compact', action='store_true',
+                        help="Compact the collections afterwards to hand the space back to the filesystem")
+    args = parser.parse_args()
+
+    asyncio.run(main(ttl=args.ttl, dry_run=args.dry_run, compact=args.compact))
@@ -1,18 +1,16 @@
 
 import logging
-from typing import List
+from typing import List, Optional
 from contextlib import asynccontextmanager
 
 import asyncio
-from fastapi import FastAPI, HTTPException, BackgroundTasks
-from fastapi.concurrency import run_in_threadpool
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import StreamingResponse
 import pymongo
 
-import torch
-
-from vectorizer.model_manager import ModelManagerFE, ModelManagerStella
 from vectorizer.settings import setup_logger, settings
 from vectorizer.models import Status, TaskModel, VectorizeParams
+from vectorizer.utils import iter_ndjson_chunks
 from vectorizer.db import DBClient
 
 
@@ -22,62 +20,50 @@ logger = logging.getLogger(__name__)
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    app.state.model_manager = ModelManagerStella("dunzhang/stella_en_1.5B_v5")
-    # app.state.model_manager = ModelManagerFE('BAAI/bge-m3')
     app.state.db_client = await DBClient.create()
+    worker = None
+    if settings.SERVER_WORKER:
+        # single-process deployment, otherwise run `python -m vectorizer.worker`
+        from vectorizer.worker import create_model_manager, run_worker
+        app.state.model_manager = create_model_manager()
+        stop = asyncio.Event()
+        worker = asyncio.create_task(run_worker(app.state.db_client, app.state.model_manager, stop=stop))
     yield
-    app.state.model_manager.close()
+    if worker is not None:
+        stop.set()
+        await worker
+        app.state.model_manager.close()
     app.state.db_client.close()
 
 
 app = FastAPI(title="Vectorizer Backend", lifespan=lifespan)
 
 
-async def vectorize_task(task_id, texts, doc_ids):
-    attempts = 0
-
-    while attempts < settings.MAX_RETRIES:
-        if torch.cuda.is_available():
-            # Attempt to move the model to GPU and run the task
-            try:
-                app.state.model_manager.load_model()
-                app.state.model_manager.move_model_to_gpu()
-                vectors = await run_in_threadpool(
-                    app.state.model_manager.get_model().encode, texts, settings.BATCH_SIZE)
-                vectors = vectors.tolist()
-                app.state.model_manager.move_model_to_cpu()
-                # Update the task status to done
-                await app.state.db_client.store_vectors(task_id, vectors, doc_ids)
-                await app.state.db_client.update_task_status(task_id, Status.DONE)
-                break
-            except Exception as e:
-                if "CUDA out of memory" in str(e):
-                    await app.state.db_client.update_task_status(
-                        task_id, Status.RETRYING, attempts=attempts, message="GPU OOM", e=str(e))
-                    await asyncio.sleep(settings.RETRY_DELAY)
-                    attempts += 1
-                    continue
-                else:
-                    await app.state.db_client.update_task_status(
-                        task_id, Status.RUNTIMEERROR, attempts=attempts, e=str(e))
-                    break
-        else:
-            await app.state.db_client.update_task_status(
-                task_id, Status.RETRYING, attempts=attempts, message="GPU not available")
-            await asyncio.sleep(settings.RETRY_DELAY)
-            attempts += 1
-
-    if attempts >= settings.MAX_RETRIES:
-        await app.state.db_client.update_task_status(task_id, Status.TIMEOUT)
+@app.post("/vectorize")
+async def vectorize(params: VectorizeParams):
+    """
+    Enqueue a task, which will be picked up by the next available worker
+    """
+    try:
+        return await app.state.db_client.create_task(
+            params.task_id, params.texts, params.doc_ids, priority=params.priority)
+    except pymongo.errors.DuplicateKeyError:
+        raise HTTPException(status_code=500, detail="Document already vectorized")
+    except Exception as e:
+        logger.info("Error while vectorizing")
+        logger.info(str(e))
+        raise HTTPException(status_code=500, detail="Unknown " + str(e))
 
 
-@app.post("/vectorize")
-async def vectorize(params: VectorizeParams, background_tasks: BackgroundTasks):
-    task_id, texts, doc_ids = params.task_id, params.texts, params.doc_ids
+@app.post("/vectorize-stream")
+async def vectorize_stream(request: Request, task_id: str, priority: int=0):
+    """
+    Streaming version of /vectorize. The body holds newline-delimited json objects with
+    "text" and "doc_id" fields, which are stored in input chunks as they arrive.
+    """
     try:
-        task = await app.state.db_client.create_task(task_id, texts, doc_ids)
-        background_tasks.add_task(vectorize_task, task_id, texts, doc_ids)
-        return task
+        return await app.state.db_client.create_task_from_chunks(
+            task_id, iter_ndjson_chunks(request.stream(), settings.INPUT_CHUNK_SIZE), priority=priority)
     except pymongo.errors.DuplicateKeyError:
         raise HTTPException(status_code=500, detail="Document already vectorized")
     except Exception as e:
@@ -86,6 +72,32 @@ async def vectorize(params: VectorizeParams, background_tasks: BackgroundTasks):
         raise HTTPException(status_code=500, detail="Unknown " + str(e))
 
 
+@app.get("/vectors/{task_id}")
+async def get_vectors(task_id: str):
+    """
+    Vectors of a finished task as a binary stream (see `DBClient.iter_packed_vectors`)
+    """
+    task = await app.state.db_client.get_task(task_id)
+    if not task:
+        raise HTTPException(status_code=404, detail="Task not found")
+    if task["current_status"]["status"] != Status.DONE:
+        raise HTTPException(status_code=409, detail="Task not done")
+    return StreamingResponse(
+        app.state.db_client.iter_packed_vectors(task_id),
+        media_type="application/octet-stream",
+        headers={"X-Vector-Dtype": settings.VECTOR_DTYPE, "X-Vector-Count": str(task["n_texts"])})
+
+
+@app.post("/ack/{task_id}")
+async def ack_task(task_id: str):
+    """
+    Acknowledge that the vectors of a finished task were ingested, so that they can be removed
+    """
+    if not await app.state.db_client.ack_task(task_id):
+        raise HTTPException(status_code=404, detail="Finished task not found")
+    return {"task_id": task_id, "acked": True}
+
+
 @app.get("/check-status/{task_id}", response_model=TaskModel)
 async def task_status(task_id: str):
     task = await app.state.db_client.get_task(task_id)
@@ -95,6 +107,22 @@ async def task_status(task_id: str):
         raise HTTPException(status_code=404, detail="Task not found")
 
 
+@app.get("/wait-status/{task_id}", response_model=TaskModel)
+async def wait_task_status(task_id: str, status: Optional[str]=None, progress: Optional[int]=None,
+                           timeout: Optional[float]=None):
+    """
+    Long-polling version of /check-status: the request is held open until the status of the
+    task differs from `status` (the last status seen by the client) or the progress from
+    `progress`, or the timeout expires
+    """
+    timeout = min(timeout or settings.STATUS_POLL_TIMEOUT, settings.STATUS_POLL_TIMEOUT)
+    task = await app.state.db_client.wait_task(task_id, status=status, progress=progress, timeout=timeout)
+    if task:
+        return task
+    else:
+        raise HTTPException(status_code=404, detail="Task not found")
+
+
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser()
@@ -1,5 +1,5 @@
 
-from typing import Type, Tuple
+from typing import Type, Tuple, Literal
 import logging.config
 
 from pydantic_settings import BaseSettings, SettingsConfigDict
@@ -21,13 +21,55 @@ class Settings(BaseSettings):
     VECTORIZER_DB: str = Field(default="vectorizer")
     TASKS_COLL: str = Field(default="tasks")
     VECTORS_COLL: str = Field(default="vectors")
+    INPUTS_COLL: str = Field(help="Collection holding the texts of queued tasks", default="inputs")
+    CACHE_COLL: str = Field(help="Collection holding the embedding cache", default="cache")
+    EMBEDDING_CACHE: bool = Field(help="Reuse the embeddings of texts that were already encoded", default=True)
+    INPUT_CHUNK_SIZE: int = Field(help="Number of texts per stored input chunk", default=1_000)
+    VECTOR_DTYPE: Literal["float16", "float32"] = Field(
+        help="Type used to store the vectors as binary blobs", default="float16")
+
+    VECTORS_TTL: int = Field(
+        help="Secs after which the vectors of finished tasks are removed, even if they weren't acknowledged",
+        default=3600 * 24 * 7)
+    GC_INTERVAL: int = Field(help="Secs between garbage collections run by idle workers (0 disables it)", default=3600)
+
+    BATCH_SIZE: int = Field(help="Max. number of texts per micro-batch", default=48)
+    BATCH_TOKEN_BUDGET: int = Field(
+        help="Max. number of tokens per micro-batch (batch size times the longest text)", default=16_384)
+    BATCH_WINDOW: int = Field(
+        help="Number of micro-batches worth of texts sorted by length together", default=16)
+    MAX_SEQ_LENGTH: int = Field(help="Texts are truncated to this number of tokens", default=512)
+    BATCH_POOL_SIZE: int = Field(
+        help="Number of texts a worker admits from the queue to be batched together", default=20_000)
+    DEVICE: Literal["auto", "cuda", "cpu"] = Field(
+        help="Device to encode on ('auto' uses the GPU if available and the CPU otherwise)", default="auto")
+    CPU_THREADS: int = Field(help="Number of threads for CPU inference (0 uses all cores)", default=0)
+    CPU_QUANTIZE: bool = Field(help="Dynamic int8 quantization of the model on GPU-less hosts", default=True)
+    CPU_FALLBACK_OOMS: int = Field(
+        help="Number of GPU OOM errors after which a task is encoded on the CPU (0 disables it)", default=2)
+    MODEL_IDLE_TIMEOUT: float = Field(
+        help="Secs without work after which the model is moved from the GPU back to the CPU", default=300)
+    MODEL_MIN_FREE_MEMORY: float = Field(
+        help="Fraction of free GPU memory under which an idle model is moved back to the CPU", default=0.05)
 
-    BATCH_SIZE: int = Field(default=48)
     RETRY_DELAY: int = Field(default=3600 * 10)
     MAX_RETRIES: int = Field(default=5)
 
     WORKERS: int = Field(help="Number of workers for the uvicorn server", default=1)
 
+    QUEUE_LEASE_TIME: int = Field(
+        help="Secs after which a task is handed to another worker if its worker stops sending heartbeats",
+        default=300)
+    QUEUE_POLL_INTERVAL: float = Field(help="Secs between queue checks of an idle worker", default=1)
+    SERVER_WORKER: bool = Field(
+        help="Run a queue worker inside the server process (instead of separate `vectorizer.worker` processes)",
+        default=False)
+
+    STATUS_POLL_TIMEOUT: float = Field(help="Max. secs a status request is held open waiting for changes", default=30)
+    STATUS_CHECK_INTERVAL: float = Field(
+        help="Secs between database checks while holding a status request (for updates from other processes)",
+        default=1)
+
     model_config = SettingsConfigDict(toml_file=["settings_vectorizer.toml"])
 
     @classmethod
@@ -1,7 +1,64 @@
-
+import json
+import hashlib
 import asyncio
+import unicodedata
+
+import numpy as np
+from bson.binary import Binary
+
 
 async def maybe_await(value):
     if asyncio.iscoroutine(value):
         return await value
     return value
+
+
+def encode_vector(vector, dtype="float16") -> Binary:
+    """
+    Pack a vector into a compact binary blob of the given dtype
+    """
+    return Binary(np.ascontiguousarray(vector, dtype=dtype).tobytes())
+
+
+def decode_vector(data: bytes, dtype="float16") -> np.ndarray:
+    """
+    Zero-copy view of a binary blob as a (read-only) NumPy vector
+    """
+    return np.frombuffer(data, dtype=dtype)
+
+
+def normalize_text(text: str) -> str:
+    return unicodedata.normalize("NFC", " ".join(text.split()))
+
+
+def cache_key(model_name: str, text: str) -> bytes:
+    """
+    Content address of the embedding of a text by a given model
+    """
+    return hashlib.sha256("{}\0{}".format(model_name, normalize_text(text)).encode()).digest()
+
+
+async def iter_ndjson_chunks(stream, chunk_size):
+    """
+    Parse a byte stream of newline-delimited {"text": ..., "doc_id": ...} objects into
+    (texts, doc_ids) chunks, without holding the whole body in memory
+    """
+    texts, doc_ids, buffer = [], [], b""
+    async for data in stream:
+        buffer += data
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            texts.append(item["text"])
+            doc_ids.append(str(item["doc_id"]))
+            if len(texts) == chunk_size:
+                yield texts, doc_ids
+                texts, doc_ids = [], []
+    if buffer.strip():
+        item = json.loads(buffer)
+        texts.append(item["text"])
+        doc_ids.append(str(item["doc_id"]))
+    if texts:
+        yield texts, doc_ids
@@ -0,0 +1,214 @@
+import os
+import time
+import socket
+import logging
+import uuid
+
+import asyncio
+from fastapi.concurrency import run_in_threadpool
+
+from vectorizer.model_manager import ModelManagerFE, ModelManagerStella
+from vectorizer.settings import settings
+from vectorizer.models import Status
+from vectorizer.batcher import MicroBatcher
+from vectorizer.utils import cache_key
+
+
+logger = logging.getLogger(__name__)
+
+
+def create_model_manager():
+    return ModelManagerStella("dunzhang/stella_en_1.5B_v5")
+    # return ModelManagerFE('BAAI/bge-m3')
+
+
+def get_worker_id():
+    return "{}-{}-{}".format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:6])
+
+
+def start_heartbeat(db_client, task_id, worker_id):
+    """
+    Renew the lease of a task in the background while it is being processed
+    """
+    async def beat():
+        while True:
+            await asyncio.sleep(settings.QUEUE_LEASE_TIME / 3)
+            if not await db_client.heartbeat(task_id, worker_id):
+                logger.info(f"Worker [{worker_id}] lost the lease on task [{task_id}]")
+                return
+
+    return asyncio.create_task(beat())
+
+
+class Worker:
+    """
+    Queue consumer. The worker leases tasks as long as there is room in its pool of texts,
+    and encodes the texts of all leased tasks together in micro-batches (see `MicroBatcher`),
+    so that bursts of small tasks share batches instead of being encoded one after another.
+    """
+    def __init__(self, db_client, model_manager, worker_id=None) -> None:
+        self.db_client = db_client
+        self.model_manager = model_manager
+        self.worker_id = worker_id or get_worker_id()
+        self.batcher = MicroBatcher(model_manager)
+        self.heartbeats = {}
+        self.last_gc = None
+
+    async def admit(self):
+        """
+        Lease tasks until the pool of texts is full or the queue is empty
+        """
+        while len(self.batcher) < settings.BATCH_POOL_SIZE:
+            task = await self.db_client.lease_task(self.worker_id)
+            if task is None:
+                return
+            task_id = task["task_id"]
+            # resume after the chunks stored by previous attempts, dropping any partial chunk
+            progress, chunks_done = task.get("progress", 0), task.get("chunks_done", 0)
+            await self.db_client.vectors_coll.delete_many({"task_id": task_id, "vector_id": {"$gte": progress}})
+            texts, doc_ids, chunk_sizes = [], [], []
+            async for chunk_texts, chunk_doc_ids in self.db_client.iter_inputs(task_id, from_chunk=chunks_done):
+                texts.extend(chunk_texts)
+                doc_ids.extend(chunk_doc_ids)
+                chunk_sizes.append(len(chunk_texts))
+            # only encode unique texts that aren't cached
+            cache_name = self.model_manager.cache_name
+            keys = [cache_key(cache_name, text) for text in texts]
+            unique = dict(zip(keys, texts))
+            hits = {}
+            if settings.EMBEDDING_CACHE:
+                hits = await self.db_client.get_cached(cache_name, list(unique))
+            misses = [key for key in unique if key not in hits]
+            logger.info(f"Task [{task_id}]: {len(texts)} texts, {len(unique)} unique, {len(hits)} cached"
+                        + (f" (resuming after {progress})" if progress else ""))
+            device = task.get("device") or self.model_manager.select_device()
+            if misses and device is None:
+                await self.db_client.retry_task(
+                    task_id, self.worker_id, settings.RETRY_DELAY, message="GPU not available")
+                continue
+            self.heartbeats[task_id] = start_heartbeat(self.db_client, task_id, self.worker_id)
+            await run_in_threadpool(
+                self.batcher.add, task, [unique[key] for key in misses], doc_ids,
+                keys=keys, miss_keys=misses, hits=hits, device=device, chunk_sizes=chunk_sizes, offset=progress)
+
+    def release(self, task_id):
+        self.batcher.tasks.pop(task_id, None)
+        heartbeat = self.heartbeats.pop(task_id, None)
+        if heartbeat is not None:
+            heartbeat.cancel()
+
+    async def flush(self, pending):
+        """
+        Store the vectors of the input chunks that are complete and cache the new vectors
+        """
+        keys, vectors = pending.new_encoded()
+        if settings.EMBEDDING_CACHE and keys:
+            await self.db_client.cache_vectors(self.model_manager.cache_name, keys, vectors)
+        for start, end in pending.ready_chunks():
+            await self.db_client.store_vectors(
+                pending.task_id, pending.get_vectors(start, end), pending.doc_ids[start:end],
+                start_id=pending.offset + start)
+            pending.release(start, end)
+            pending.chunks_done += 1
+            await self.db_client.update_progress(
+                pending.task_id, self.worker_id, pending.offset + end,
+                pending.task.get("chunks_done", 0) + pending.chunks_done)
+
+    async def finish(self, pending):
+        task_id = pending.task_id
+        try:
+            await self.flush(pending)
+            await self.db_client.update_task_status(task_id, Status.DONE, worker_id=self.worker_id)
+            await self.db_client.delete_inputs(task_id)
+        finally:
+            self.release(task_id)
+
+    async def fail(self, e):
+        if "CUDA out of memory" in str(e):
+            # the batch may have only failed due to the other tasks, retry all of them
+            self.model_manager.maybe_evict(idle_timeout=0)
+            for task_id, pending in list(self.batcher.tasks.items()):
+                ooms = pending.task.get("ooms", 0) + 1
+                if settings.DEVICE != "cuda" and 0 < settings.CPU_FALLBACK_OOMS <= ooms:
+                    # retry right away on the CPU
+                    await self.db_client.retry_task(
+                        task_id, self.worker_id, 0, extra={"ooms": ooms, "device": "cpu"},
+                        message="GPU OOM, falling back to CPU", e=str(e))
+                else:
+                    await self.db_client.retry_task(
+                        task_id, self.worker_id, settings.RETRY_DELAY, extra={"ooms": ooms},
+                        message="GPU OOM", e=str(e))
+                self.release(task_id)
+        else:
+            for pending, _, _ in self.batcher.next_batch():
+                await self.db_client.update_task_status(
+                    pending.task_id, Status.RUNTIMEERROR, worker_id=self.worker_id,
+                    attempts=pending.task["attempts"], e=str(e))
+                self.release(pending.task_id)
+
+    async def step(self):
+        """
+        Admit new tasks, encode one micro-batch and store the finished tasks. Returns
+        False if there was nothing to do.
+        """
+        await self.admit()
+        for pending in self.batcher.finished():
+            await self.finish(pending)
+        if not self.batcher.tasks:
+            return False
+        try:
+            encoded = await run_in_threadpool(self.batcher.step)
+        except Exception as e:
+            await self.fail(e)
+            return True
+        for pending in encoded:
+            await self.flush(pending)
+        for pending in self.batcher.finished():
+            await self.finish(pending)
+        return True
+
+    async def run(self, stop=None):
+        """
+        Consume the task queue until `stop` is set
+        """
+        stop = stop or asyncio.Event()
+        logger.info(f"Starting worker [{self.worker_id}]")
+        while not stop.is_set():
+            try:
+                if not await self.step():
+                    self.model_manager.maybe_evict()
+                    await self.db_client.expire_tasks()
+                    if settings.GC_INTERVAL and (
+                            self.last_gc is None or time.monotonic() - self.last_gc > settings.GC_INTERVAL):
+                        self.last_gc = time.monotonic()
+                        await self.db_client.collect_garbage()
+                    await self.db_client.wait_status_change(settings.QUEUE_POLL_INTERVAL)
+            except Exception as e:
+                # don't let a database hiccup kill the worker, the leases will expire
+                logger.info(f"Worker [{self.worker_id}] error: {e}")
+                await asyncio.sleep(settings.QUEUE_POLL_INTERVAL)
+        for task_id in list(self.batcher.tasks):
+            self.release(task_id)
+        logger.info(f"Stopped worker [{self.worker_id}], model transfers: {self.model_manager.stats}")
+
+
+async def run_worker(db_client, model_manager, worker_id=None, stop=None):
+    await Worker(db_client, model_manager, worker_id=worker_id).run(stop=stop)
+
+
+if __name__ == "__main__":
+    from vectorizer.settings import setup_logger
+    from vectorizer.db import DBClient
+
+    setup_logger()
+
+    async def main():
+        db_client = await DBClient.create()
+        model_manager = create_model_manager()
+        try:
+            await run_worker(db_client, model_manager)
+        finally:
+            model_manager.close()
+            db_client.close()
+
+    asyncio.run(main())